@@ -1,7 +1,10 @@
-import requests
 import logging
-from functools import lru_cache, partialmethod
+from functools import partialmethod
 from itertools import islice
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession
+from .cache import ApiCache, cached, composite_keys, composite_lookup, composite_store
+from .async_api import AsyncTMDBApi
+from .export_index import ExportIndex
 
 
 def load_key_from_file(filename):
@@ -10,25 +13,34 @@ def load_key_from_file(filename):
 
 
 class TMDBApi:
-    def __init__(self, api_key, language, enable_https=False, retry=3):
+    def __init__(self, api_key, language, enable_https=False, retry=3, base_url=None, rate=40,
+                 cache=None, index=None):
         self.api_key = api_key
         self.language = language
         schema = "http" if not enable_https else "https"
-        self.base_url = f"{schema}://api.themoviedb.org/3"
+        # base_url可以指向本地替身服务器
+        self.base_url = base_url or f"{schema}://api.themoviedb.org/3"
         self.base_params = {
             "api_key": self.api_key,
             "language": self.language
         }
-        self.session = requests.Session()
-        self.session.mount(
-            self.base_url, requests.adapters.HTTPAdapter(max_retries=retry))
+        # TMDB按IP限制请求速率，收到429后自动降速并按Retry-After等待
+        self.session = RateLimitedSession(
+            RateLimiter(rate), RetryPolicy(retry))
+        # cache可以是ApiCache对象或缓存文件名，默认只缓存在内存中
+        if isinstance(cache, ApiCache):
+            self.cache = cache
+        else:
+            self.cache = ApiCache(cache or ":memory:")
+        # 由每日导出建立的ExportIndex，用于在本地解析剧名
+        self.index = index
 
     def _merge_dict(self, d):
         base_params = self.base_params.copy()
         base_params.update(d)
         return base_params
 
-    @lru_cache()
+    @cached("details")
     def get_details(self, id, target):
         logging.info(f"downloading {target}-{id} detail...")
         url = f"{self.base_url}/{target}/{id}"
@@ -39,7 +51,7 @@ class TMDBApi:
     get_movie_details = partialmethod(get_details, target="movie")
     get_person_detail = partialmethod(get_details, target="person")
 
-    @lru_cache()
+    @cached("credits")
     def get_credits(self, id, target):
         logging.info(f"downloading {target}-{id} credits...")
         url = f"{self.base_url}/{target}/{id}/credits"
@@ -48,7 +60,7 @@ class TMDBApi:
     get_tv_credits = partialmethod(get_credits, target="tv")
     get_movie_credits = partialmethod(get_credits, target="movie")
 
-    @lru_cache()
+    @cached("search")
     def search(self, query, target, page=1, first_air_date_year=None):
         logging.info(f"searching {query} {target}...")
         url = f"{self.base_url}/search/{target}"
@@ -62,7 +74,19 @@ class TMDBApi:
         )
         return r.json()
 
-    @lru_cache()
+    def find(self, name, target="tv"):
+        """按名称查找，先查本地导出索引，未命中时调用search接口
+
+        索引只用于规范化之后完全相同的名称，相似的名称可能是另一部剧，仍然交给search接口。
+        返回搜索结果列表，索引中的结果只有id、original_name和popularity。
+        """
+        if target == "tv" and self.index is not None:
+            results = self.index.search(name, fuzzy=False)
+            if results:
+                return results
+        return self.search(name, target).get("results", [])
+
+    @cached("popular")
     def get_popular(self, page, target):
         logging.info(f"get popular {target} at page {page}...")
         url = f"{self.base_url}/{target}/popular"
@@ -87,13 +111,14 @@ class TMDBApi:
                 count += item_nums
                 yield from results
 
-    @lru_cache()
+    @cached("genre")
     def get_genre_list(self, target):
         logging.info(f"get genre list for {target}...")
         url = f"{self.base_url}/genre/{target}/list"
         r = self.session.get(url, params=self.base_params)
         return r.json().get("genres", [])
 
+    @cached("external_ids")
     def get_external_ids(self, target, id):
         logging.info(f"get external_ids for {target} {id}...")
         url = f"{self.base_url}/{target}/{id}/external_ids"
@@ -102,3 +127,22 @@ class TMDBApi:
 
     get_tv_genre_list = partialmethod(get_genre_list, target="tv")
     get_movie_genre_list = partialmethod(get_genre_list, target="movie")
+
+    def get_full_details(self, id, target, parts=("credits", "external_ids"), refresh=False):
+        """用append_to_response一次请求获取详情和credits、external_ids
+
+        返回的详情中附带各部分，各部分分别缓存，之后单独调用get_credits等也能命中。
+        已经缓存的部分不会重复请求，refresh为True时忽略缓存重新获取所有部分。
+        """
+        keys = composite_keys(self, id, target, parts)
+        found, missing = composite_lookup(self.cache, keys, refresh)
+        if found["details"] is not None and not missing:
+            return dict(found["details"], **{part: found[part] for part in parts})
+        append = ",".join(missing) or None
+
+        def fetch():
+            logging.info(f"downloading {target}-{id} detail with {missing}...")
+            url = f"{self.base_url}/{target}/{id}"
+            r = self.session.get(url, params=self._merge_dict({"append_to_response": append}))
+            return composite_store(self.cache, keys, found, r.json())
+        return self.cache.flight.do(keys["details"]+str(append), fetch)
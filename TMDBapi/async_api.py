@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import math
+from functools import partialmethod
+
+import aiohttp
+
+from rate_limit import RateLimiter, RetryPolicy, async_get
+from .cache import ApiCache, async_cached, composite_keys, composite_lookup, composite_store
+
+
+class AsyncTMDBApi:
+    """TMDBApi的异步版本
+
+    方法与TMDBApi一一对应，但都是协程。所有请求复用同一个aiohttp连接池，
+    concurrency限制同时进行的请求数。需要在async with中使用。
+    """
+
+    def __init__(self, api_key, language, enable_https=False, retry=3, base_url=None, rate=40,
+                 cache=None, concurrency=16):
+        self.api_key = api_key
+        self.language = language
+        schema = "http" if not enable_https else "https"
+        self.base_url = base_url or f"{schema}://api.themoviedb.org/3"
+        self.base_params = {
+            "api_key": self.api_key,
+            "language": self.language
+        }
+        self.limiter = RateLimiter(rate)
+        self.policy = RetryPolicy(retry)
+        self.concurrency = concurrency
+        if isinstance(cache, ApiCache):
+            self.cache = cache
+        else:
+            self.cache = ApiCache(cache or ":memory:")
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    def _merge_dict(self, d):
+        # aiohttp不接受值为None的参数
+        base_params = self.base_params.copy()
+        base_params.update((k, v) for k, v in d.items() if v is not None)
+        return base_params
+
+    async def _get(self, path, params=None):
+        r = await async_get(self.session, f"{self.base_url}{path}", self.limiter, self.policy,
+                            params=self._merge_dict(params or {}))
+        # 重试之后仍然失败的响应不是JSON，也不能被缓存
+        if r.status >= 400:
+            raise aiohttp.ClientError(f"{self.base_url}{path} returned {r.status}")
+        return json.loads(r.body)
+
+    @async_cached("details")
+    async def get_details(self, id, target):
+        logging.info(f"downloading {target}-{id} detail...")
+        return await self._get(f"/{target}/{id}")
+
+    get_tv_details = partialmethod(get_details, target="tv")
+    get_movie_details = partialmethod(get_details, target="movie")
+    get_person_detail = partialmethod(get_details, target="person")
+
+    @async_cached("credits")
+    async def get_credits(self, id, target):
+        logging.info(f"downloading {target}-{id} credits...")
+        return await self._get(f"/{target}/{id}/credits")
+    get_tv_credits = partialmethod(get_credits, target="tv")
+    get_movie_credits = partialmethod(get_credits, target="movie")
+
+    @async_cached("search")
+    async def search(self, query, target, page=1, first_air_date_year=None):
+        logging.info(f"searching {query} {target}...")
+        return await self._get(f"/search/{target}", {
+            "query": query,
+            "page": page,
+            "first_air_date_year": first_air_date_year
+        })
+
+    @async_cached("popular")
+    async def get_popular(self, page, target):
+        logging.info(f"get popular {target} at page {page}...")
+        return await self._get(f"/{target}/popular", {"page": page})
+
+    async def get_popular_list(self, target, limit=float("inf")):
+        """先取第一页得到total_pages，再并发获取剩余的页面"""
+        first = await self.get_popular(1, target)
+        results = list(first["results"])
+        page_size = len(results) or 1
+        total_pages = min(first.get("total_pages", 1), 1000)
+        if limit != float("inf"):
+            total_pages = min(total_pages, math.ceil(limit/page_size))
+        pages = await asyncio.gather(
+            *(self.get_popular(page, target) for page in range(2, total_pages+1)))
+        for j in pages:
+            results.extend(j["results"])
+        return results[:limit] if limit != float("inf") else results
+
+    async def get_popular_iter(self, target, limit=float("inf")):
+        for item in await self.get_popular_list(target, limit):
+            yield item
+
+    @async_cached("genre")
+    async def get_genre_list(self, target):
+        logging.info(f"get genre list for {target}...")
+        j = await self._get(f"/genre/{target}/list")
+        return j.get("genres", [])
+
+    @async_cached("external_ids")
+    async def get_external_ids(self, target, id):
+        logging.info(f"get external_ids for {target} {id}...")
+        return await self._get(f"/{target}/{id}/external_ids")
+
+    get_tv_genre_list = partialmethod(get_genre_list, target="tv")
+    get_movie_genre_list = partialmethod(get_genre_list, target="movie")
+
+    async def get_full_details(self, id, target, parts=("credits", "external_ids"), refresh=False):
+        """TMDBApi.get_full_details的异步版本"""
+        keys = composite_keys(self, id, target, parts)
+        found, missing = composite_lookup(self.cache, keys, refresh)
+        if found["details"] is not None and not missing:
+            return dict(found["details"], **{part: found[part] for part in parts})
+        append = ",".join(missing) or None
+
+        async def fetch():
+            logging.info(f"downloading {target}-{id} detail with {missing}...")
+            j = await self._get(f"/{target}/{id}", {"append_to_response": append})
+            return composite_store(self.cache, keys, found, j)
+        return await self.cache.flight.async_do(keys["details"]+str(append), fetch)
+
+    async def get_many_details(self, ids, target, concurrency=None):
+        """并发获取多个条目的详情，返回与ids顺序一致的列表
+
+        获取失败的条目记录日志后为None，不影响其他条目。
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def fetch(id):
+            async with semaphore:
+                try:
+                    return await self.get_details(id, target)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error(f"cannot get {target}-{id} detail: {e}")
+                    return None
+
+        return await asyncio.gather(*map(fetch, ids))
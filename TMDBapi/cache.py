@@ -0,0 +1,318 @@
+import asyncio
+import atexit
+import inspect
+import json
+import logging
+import sqlite3
+import time
+import zlib
+from concurrent.futures import Future
+from functools import partial, wraps
+from threading import Lock
+
+# 各接口缓存的有效期（秒）
+DEFAULT_TTLS = {
+    "details": 7*86400,
+    "credits": 7*86400,
+    "external_ids": 30*86400,
+    "search": 86400,
+    "popular": 6*3600,
+    "genre": 30*86400,
+}
+
+
+class SingleFlight:
+    """合并并发的相同请求
+
+    同一个键同时只有一个调用真正执行，其余调用等待它的结果，
+    coalesced记录被合并的调用次数。
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.async_calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            value = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def async_do(self, key, func):
+        """do的协程版本，func是返回协程的函数"""
+        future = self.async_calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = self.async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待者时避免"exception was never retrieved"警告
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del self.async_calls[key]
+
+
+class ApiCache:
+    """TMDB响应的持久化缓存
+
+    响应以JSON压缩后保存在sqlite中，每个接口有自己的有效期。
+    缓存总大小超过max_bytes时，按最近访问时间淘汰最久未使用的条目。
+    filename为":memory:"时只在内存中缓存。
+    写入立即提交，多个进程可以共享同一个缓存文件。命中时访问时间只记录在内存中，
+    积累commit_every条或下一次写入、flush、close时再批量写入，进程退出时会自动close。
+    缓存只是尽力而为，数据库被其他进程锁定时读取视为未命中，写入被放弃。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS "cache" (
+        "key"	TEXT PRIMARY KEY,
+        "endpoint"	TEXT,
+        "value"	BLOB,
+        "size"	INTEGER,
+        "created"	REAL,
+        "accessed"	REAL
+    );
+    CREATE INDEX IF NOT EXISTS "cache_accessed" ON "cache" ("accessed");
+    """
+
+    def __init__(self, filename=":memory:", ttls=None, max_bytes=256*1024*1024, commit_every=100):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # 还没有写入数据库的访问时间{key: accessed}
+        self.accessed = {}
+        self.closed = False
+        atexit.register(self.close)
+        self.size = self.conn.execute(
+            "SELECT coalesce(sum(size),0) FROM cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 正在进行的请求，缓存未命中的并发调用在这里合并
+        self.flight = SingleFlight()
+
+    def get(self, endpoint, key):
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.conn.execute(
+                    "SELECT value,created FROM cache WHERE key=?", (key,)).fetchone()
+            except sqlite3.OperationalError as e:
+                logging.warning(f"cache get failed: {e}")
+                row = None
+            if row is None or now-row[1] > self.ttls.get(endpoint, 0):
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            self.hits += 1
+            if len(self.accessed) >= self.commit_every:
+                self._commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, endpoint, key, value):
+        blob = zlib.compress(json.dumps(
+            value, ensure_ascii=False).encode("utf8"))
+        now = time.time()
+        with self.lock:
+            size = self.size
+            try:
+                old = self.conn.execute(
+                    "SELECT size FROM cache WHERE key=?", (key,)).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache (key,endpoint,value,size,created,accessed) VALUES(?,?,?,?,?,?)",
+                    (key, endpoint, blob, len(blob), now, now))
+                self.size += len(blob)-(old[0] if old else 0)
+                self.accessed.pop(key, None)
+                self._evict()
+                self._save_accessed()
+                self.conn.commit()
+            except sqlite3.OperationalError as e:
+                self.conn.rollback()
+                self.size = size
+                logging.warning(f"cache put failed: {e}")
+
+    def _save_accessed(self):
+        if self.accessed:
+            self.conn.executemany("UPDATE cache SET accessed=? WHERE key=?",
+                                  ((t, key) for key, t in self.accessed.items()))
+            self.accessed.clear()
+
+    def _commit(self):
+        """写入积累的访问时间，失败时放弃，调用时必须持有锁"""
+        try:
+            self._save_accessed()
+            self.conn.commit()
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            logging.warning(f"cache commit failed: {e}")
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def _evict(self):
+        """淘汰最久未访问的条目直到总大小不超过上限，调用时必须持有锁"""
+        if self.size > self.max_bytes:
+            # 淘汰顺序依赖数据库中的访问时间
+            self._save_accessed()
+        while self.size > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key,size FROM cache ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM cache WHERE key=?", (key,))
+                self.size -= size
+                self.evictions += 1
+                if self.size <= self.max_bytes:
+                    break
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self.flight.coalesced,
+            "bytes": self.size,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._commit()
+            self.conn.close()
+            self.closed = True
+        atexit.unregister(self.close)
+
+
+def make_key(func, signature, self, args, kwargs):
+    """参数先按函数签名绑定，get_details(1, "tv")和get_tv_details(1)使用同一个键"""
+    bound = signature.bind(self, *args, **kwargs)
+    bound.apply_defaults()
+    params = list(bound.arguments.items())[1:]
+    return json.dumps([func.__name__, self.language, params], ensure_ascii=False)
+
+
+def store(cache, endpoint, key, func, value):
+    """TMDB返回的错误信息不会被缓存"""
+    if isinstance(value, dict) and value.get("success") is False:
+        logging.warning(f"{func.__name__} failed: {value}")
+    else:
+        cache.put(endpoint, key, value)
+
+
+def cached(endpoint):
+    """把方法的返回值缓存到self.cache"""
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def inner(self, *args, **kwargs):
+            key = make_key(func, signature, self, args, kwargs)
+            value = self.cache.get(endpoint, key)
+            if value is None:
+                value = self.cache.flight.do(key, partial(fetch, self, key, args, kwargs))
+            return value
+
+        def fetch(self, key, args, kwargs):
+            value = func(self, *args, **kwargs)
+            store(self.cache, endpoint, key, func, value)
+            return value
+        inner.make_key = partial(make_key, func, signature)
+        return inner
+    return decorator
+
+
+def async_cached(endpoint):
+    """cached的协程版本"""
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def inner(self, *args, **kwargs):
+            key = make_key(func, signature, self, args, kwargs)
+            value = self.cache.get(endpoint, key)
+            if value is None:
+                value = await self.cache.flight.async_do(key, partial(fetch, self, key, args, kwargs))
+            return value
+
+        async def fetch(self, key, args, kwargs):
+            value = await func(self, *args, **kwargs)
+            store(self.cache, endpoint, key, func, value)
+            return value
+        inner.make_key = partial(make_key, func, signature)
+        return inner
+    return decorator
+
+
+# append_to_response可以附加的部分及其对应的方法
+APPEND_METHODS = {
+    "credits": "get_credits",
+    "external_ids": "get_external_ids",
+}
+
+
+def composite_keys(api, id, target, parts):
+    """复合请求中各部分的缓存键，与单独调用对应方法时的键相同"""
+    cls = type(api)
+    keys = {"details": cls.get_details.make_key(api, (), {"id": id, "target": target})}
+    for part in parts:
+        method = getattr(cls, APPEND_METHODS[part])
+        keys[part] = method.make_key(api, (), {"id": id, "target": target})
+    return keys
+
+
+def composite_lookup(cache, keys, refresh=False):
+    """返回缓存中已有的部分和需要请求的附加部分，refresh为True时视为都没有缓存"""
+    if refresh:
+        return dict.fromkeys(keys), [part for part in keys if part != "details"]
+    found = {part: cache.get(part, key) for part, key in keys.items()}
+    missing = [part for part, value in found.items()
+               if value is None and part != "details"]
+    return found, missing
+
+
+def composite_store(cache, keys, found, j):
+    """把复合响应拆开分别缓存，返回详情中附带各部分的字典"""
+    if j.get("success") is False:
+        logging.warning(f"composite request failed: {j}")
+        return j
+    for part in keys:
+        if part != "details" and part in j:
+            found[part] = j.pop(part)
+            cache.put(part, keys[part], found[part])
+    cache.put("details", keys["details"], j)
+    return dict(j, **{part: found[part] for part in keys if part != "details"})
@@ -0,0 +1,112 @@
+import difflib
+import gzip
+import json
+import logging
+import re
+import unicodedata
+from collections import defaultdict
+from datetime import date
+from pathlib import Path
+
+EXPORT_RE = re.compile(r"tv_series_ids_(\d{2})_(\d{2})_(\d{4})\.json\.gz")
+# 去掉标点、空白和常见的季数后缀再比较名称
+PUNCTUATION_RE = re.compile(r"[\W_]+")
+SEASON_RE = re.compile(r"(第.季|season\s*\d+)$")
+
+
+def normalize(name):
+    name = unicodedata.normalize("NFKC", name).casefold().strip()
+    name = SEASON_RE.sub("", name)
+    return PUNCTUATION_RE.sub("", name)
+
+
+def bigrams(name):
+    return {name[i:i+2] for i in range(len(name)-1)} or {name}
+
+
+def export_date(fpath):
+    month, day, year = map(int, EXPORT_RE.match(fpath.name).groups())
+    return date(year, month, day)
+
+
+class ExportIndex:
+    """由TMDB每日导出tv_series_ids_*.json.gz建立的本地索引
+
+    提供id到original_name/popularity的查询，以及规范化名称到id的精确和模糊查询，
+    可以在不请求API的情况下完成搜索和获取基本信息。
+    """
+
+    def __init__(self, items=()):
+        self.items = {}
+        self.names = defaultdict(list)
+        self.grams = defaultdict(set)
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, id):
+        return id in self.items
+
+    def add(self, item):
+        id = item["id"]
+        self.items[id] = (item["original_name"], item["popularity"])
+        key = normalize(item["original_name"])
+        if not key:
+            return
+        if key not in self.names:
+            for gram in bigrams(key):
+                self.grams[gram].add(key)
+        self.names[key].append(id)
+
+    @classmethod
+    def from_file(cls, fpath):
+        logging.info(f"building export index from {fpath}...")
+        with gzip.open(fpath, "rb") as f:
+            return cls(json.loads(line) for line in f if line.strip())
+
+    @classmethod
+    def from_dir(cls, path="data"):
+        """使用目录下日期最新的导出文件，没有导出文件时返回None"""
+        files = [f for f in Path(path).glob("tv_series_ids_*.json.gz")
+                 if EXPORT_RE.match(f.name)]
+        if not files:
+            return None
+        return cls.from_file(max(files, key=export_date))
+
+    def get(self, id):
+        """返回与TMDB搜索结果格式相同的字典，不存在时返回None"""
+        if id not in self.items:
+            return None
+        original_name, popularity = self.items[id]
+        return {"id": id, "original_name": original_name, "popularity": popularity}
+
+    def _ranked(self, ids):
+        return sorted((self.get(id) for id in ids), key=lambda d: d["popularity"], reverse=True)
+
+    def search(self, name, fuzzy=True, limit=10, cutoff=0.75):
+        """按名称查找，同名的结果按popularity降序排列
+
+        精确匹配（规范化之后）失败时，用共同的二元组筛选候选名称，再按相似度模糊匹配，
+        相似度高的名称排在前面。
+        """
+        key = normalize(name)
+        if not key:
+            return []
+        if key in self.names:
+            return self._ranked(self.names[key])[:limit]
+        if not fuzzy:
+            return []
+        counts = defaultdict(int)
+        # 从最少见的二元组开始统计，太常见的二元组几乎不能区分名称，跳过以节省时间
+        postings = sorted((self.grams.get(gram, ()) for gram in bigrams(key)), key=len)
+        for names in postings:
+            if counts and len(names) > 2000:
+                break
+            for candidate in names:
+                counts[candidate] += 1
+        # 只对共同二元组最多的候选计算相似度
+        candidates = sorted(counts, key=counts.get, reverse=True)[:200]
+        matches = difflib.get_close_matches(key, candidates, n=limit, cutoff=cutoff)
+        return [item for match in matches for item in self._ranked(self.names[match])][:limit]
@@ -1,11 +1,13 @@
+import asyncio
 import sqlite3
 from datetime import date, timedelta
 import logging
-import requests
 import time
 import json
 import pandas as pd
 import argparse
+from TMDBapi import AsyncTMDBApi, ExportIndex
+from popularity_query import PopularityRanking
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,6 +18,15 @@ parser.add_argument("days", help="总共分析的天数【请确保所有日期
 parser.add_argument("-k", "--key", help="API密钥")
 parser.add_argument("-o", "--output", help="输出文件名，支持使用{start_date}和{end_date}格式化",
                     default="data/top10_{start_date}_{end_date}.csv")
+parser.add_argument("-r", "--rate", help="每秒请求数的初始值，之后根据服务器响应自动调整",
+                    default=40, type=float)
+parser.add_argument("-n", "--number", help="每天取欢迎度最高的条目数", default=10, type=int)
+parser.add_argument("-d", "--db", help="read_daily_exports.py生成的数据库", default="tv.db")
+parser.add_argument("-t", "--trend", help="输出上榜条目完整欢迎度趋势的JSON文件名，支持使用{start_date}和{end_date}格式化")
+parser.add_argument("-c", "--concurrency", help="同时进行的API请求数", default=16, type=int)
+parser.add_argument("--cache", help="TMDB响应缓存文件，多次运行之间共享", default="tmdb_cache.db")
+parser.add_argument("--api-url", help="TMDB API地址，可以指向local_server.py启动的替身服务器")
+parser.add_argument("-i", "--index", help="TMDB每日导出所在目录，API无法获取详情时使用导出中的原名，此时region为空")
 
 
 def get_api_from_file():
@@ -24,63 +35,83 @@ def get_api_from_file():
     return key
 
 
-def fetch_top10(cur_date):
-    logging.info(
-        f"fetching top10 tvs at date {cur_date.strftime('%Y-%m-%d')}...")
+def fetch_topN(date_list, n):
+    logging.info(f"fetching top{n} tvs from {date_list[0]} to {date_list[-1]}...")
     start_time = time.time()
-    cur.execute(sql, (f"{cur_date.year}-{cur_date.month}-{cur_date.day}",))
+    ans = ranking.top_n(date_list, n)
     end_time = time.time()
-    ans = cur.fetchall()
     logging.info(
-        f"fetch top10 tvs at date {cur_date} complete. Time use: {end_time-start_time}s. Ans={ans}")
+        f"fetch top{n} tvs of {len(date_list)} days complete. Time use: {end_time-start_time}s")
     return ans
 
 
-def id2info(id):
-    url = API_ENDPOINT.format(tv_id=id)
-    logging.info(f"connect to {url}...")
-    r = requests.get(url, params={
-        "api_key": API_KEY,
-        "language": "zh-CN"
-    })
-    j = r.json()
-    d = {
+def id2info(j):
+    """把剧集详情转换为输出的字典"""
+    countries = j.get("origin_country") or [""]
+    return {
         "name": j["name"],
-        "region": j['origin_country'][0] if j['origin_country'] else "",
-        "image_url": IMAGE_URL.format(country=j['origin_country'][0] if j['origin_country'] else "")
+        "region": countries[0],
+        "image_url": IMAGE_URL.format(country=countries[0])
     }
-    logging.info(
-        f"successfully download {j['name']} info. original country is {j['origin_country']}")
-    return d
+
+
+async def ids2info(ids, api, index=None):
+    """批量获取ids对应的信息，返回{id: info}
+
+    通过API并发获取，详情保存在持久化缓存中，重复运行时不再请求。
+    API无法获取的id如果在本地导出索引中，使用导出中的原名，region和image_url为空；
+    否则记录日志后不出现在结果中。
+    """
+    ans = {}
+    async with api:
+        details = await api.get_many_details(ids, "tv")
+    for id, j in zip(ids, details):
+        if j is not None and "name" in j:
+            ans[id] = id2info(j)
+            continue
+        item = index.get(id) if index is not None else None
+        if item is not None:
+            logging.warning(f"cannot get detail of {id}: {j}, use name in index")
+            ans[id] = {"name": item["original_name"], "region": "", "image_url": ""}
+        elif j is not None:
+            logging.error(f"cannot get detail of {id}: {j}")
+    logging.info(f"api cache stats: {api.cache.stats()}")
+    return ans
 
 
 if __name__ == "__main__":
-    conn = sqlite3.connect("tv.db")
-    sql = "SELECT id,popularity FROM popularity WHERE create_at=? ORDER BY popularity DESC LIMIT 10"
-    cur = conn.cursor()
     arg = parser.parse_args()
+    conn = sqlite3.connect(arg.db)
+    ranking = PopularityRanking(conn)
     start_date = arg.start
     days = arg.days
-    tv_infos = {}
     API_KEY = arg.key or get_api_from_file()
-    API_ENDPOINT = "http://api.themoviedb.org/3/tv/{tv_id}"
     IMAGE_URL = "https://www.countryflags.io/{country}/flat/64.png"
+    api = AsyncTMDBApi(API_KEY, "zh-CN", base_url=arg.api_url, rate=arg.rate, cache=arg.cache,
+                       concurrency=arg.concurrency)
+    index = ExportIndex.from_dir(arg.index) if arg.index else None
 
     date_list = list(start_date+n*timedelta(days=1) for n in range(days))
-    top10_lists = (fetch_top10(d) for d in date_list)
-
-    # 下载id对应的影视信息
-    for top10_list, cur_date in zip(top10_lists, date_list):
-        id_sets = set(item[0] for item in top10_list)
-        id_sets -= tv_infos.keys()
-        cur_tv_info = ((id, id2info(id)) for id in id_sets)
-        tv_infos.update(cur_tv_info)
-        for id, popularity in top10_list:
-            tv_infos[id][cur_date.strftime('%Y-%m-%d')] = popularity
-        time.sleep(.1)
+    top_lists = fetch_topN(date_list, arg.number)
+
+    # 一次性下载所有上榜id对应的影视信息
+    ids = list(dict.fromkeys(id for top_list in top_lists.values() for id, _ in top_list))
+    tv_infos = asyncio.run(ids2info(ids, api, index))
+    for cur_date, top_list in top_lists.items():
+        for id, popularity in top_list:
+            if id in tv_infos:
+                tv_infos[id][cur_date.strftime('%Y-%m-%d')] = popularity
 
     df = pd.DataFrame(list(tv_infos.values()), columns=(
         "name", "region", "image_url", *map(str, date_list)))
-    filename = arg.filename.format(
+    filename = arg.output.format(
         start_date=start_date, end_date=start_date+timedelta(days=days))
     df.to_csv(filename, na_rep="0")
+    if arg.trend:
+        # 上榜条目在整个日期范围内的欢迎度，不只是上榜的那几天
+        trend = ranking.trend(tv_infos.keys(), date_list)
+        filename = arg.trend.format(
+            start_date=start_date, end_date=start_date+timedelta(days=days))
+        with open(filename, "w") as f:
+            json.dump({tv_infos[id]["name"]: values for id, values in trend.items()},
+                      f, indent=4)
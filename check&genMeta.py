@@ -1,5 +1,5 @@
 from pathlib import Path
-from TMDBApi import TMDBApi, load_key_from_file
+from TMDBApi import TMDBApi, ExportIndex, load_key_from_file
 import json
 import itertools
 import re
@@ -7,7 +7,9 @@ import warnings
 
 skip = {"请输入搜索词：www"}
 
-api = TMDBApi(load_key_from_file("api.key"), "zh-CN")
+# popularity_downloader.py下载的每日导出可以在本地解析大部分剧名
+api = TMDBApi(load_key_from_file("api.key"), "zh-CN", cache="tmdb_cache.db",
+              index=ExportIndex.from_dir("data"))
 TV_paths = (p for p in Path("./data/TVs").iterdir()
             if p.is_dir() and p.name not in skip)
 
@@ -47,8 +49,8 @@ for TV_path in TV_paths:
         season = se[0][0]
         episodes = [int(t[1]) for t in se]
         name = re.sub("\s*第.季", "", TV_path.name)
-        res = api.search(name, "tv")
-        tv_id = res['results'][0]['id'] if len(res['results']) > 0 else 0
+        results = api.find(name, "tv")
+        tv_id = results[0]['id'] if len(results) > 0 else 0
         if tv_id == 0:
             print(f"❌:{TV_path}没有找到id")
         json.dump({
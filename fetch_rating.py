@@ -5,7 +5,7 @@ import json
 from TMDBApi import TMDBApi, load_key_from_file
 tmdb_key = load_key_from_file("api.key")
 
-api = TMDBApi(tmdb_key, "zh-CN")
+api = TMDBApi(tmdb_key, "zh-CN", cache="tmdb_cache.db")
 KEY = ["k_FS90bMM6", "k_68tfLT53", "k_YDWk2fjE", ]
 api_key = KEY[1]
 TVs = (x for x in Path("./data/TVs").iterdir() if x.is_dir())
@@ -0,0 +1,374 @@
+"""图数据的批量加载器
+
+节点和关系先收集到GraphBatch中，再交给某个GraphLoader写入：
+Neo4jLoader按标签和关系类型分组，用参数化的UNWIND ... MERGE语句在一个事务中写入；
+CsvExporter导出neo4j-admin import使用的CSV；memory_graph.MemoryGraph是内嵌的内存图。
+"""
+import csv
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from itertools import islice
+from pathlib import Path
+from threading import Lock
+
+NODE_CYPHER = "UNWIND $rows AS row MERGE (n:`{label}` {{id: row.id}}) ON CREATE SET n += row.props"
+UPDATE_CYPHER = "UNWIND $rows AS row MERGE (n:`{label}` {{id: row.id}}) SET n += row.props"
+REL_CYPHER = (
+    "UNWIND $rows AS row "
+    "MATCH (a:`{start}` {{id: row.start}}) "
+    "MATCH (b:`{end}` {{id: row.end}}) "
+    "MERGE (a)-[r:`{type}`]->(b) ON CREATE SET r += row.props"
+)
+EXISTS_CYPHER = "MATCH (n:`{label}`) WHERE n.id IN $ids RETURN n.id AS id"
+NODES_CYPHER = "MATCH (n:`{label}`) WHERE n.id IN $ids RETURN n.id AS id, properties(n) AS props"
+CO_STARS_CYPHER = (
+    "MATCH (a:`{label}` {{id: $id}})<-[:`{label}`]-(s)-[:`{label}`]->(b:`{label}`) WHERE b <> a "
+    "RETURN b.id AS id, count(s) AS shared ORDER BY shared DESC"
+)
+SHOWS_BY_GENRE_CYPHER = "MATCH (s:`{label}`)-[:is]->(:genre {{id: $id}}) RETURN s.id AS id ORDER BY id"
+SHORTEST_PATH_CYPHER = (
+    "MATCH (a:`{label}` {{id: $start}}), (b:`{label}` {{id: $end}}), "
+    "p = shortestPath((a)-[:`{label}`*]-(b)) "
+    "RETURN [n IN nodes(p) | [labels(n)[0], n.id]] AS path"
+)
+# Neo4j 4.4之后的语法，旧版本不支持IF NOT EXISTS，使用CONSTRAINT_CYPHER_LEGACY并忽略约束已经存在的错误
+CONSTRAINT_CYPHER = "CREATE CONSTRAINT IF NOT EXISTS FOR (n:`{label}`) REQUIRE n.id IS UNIQUE"
+CONSTRAINT_CYPHER_LEGACY = "CREATE CONSTRAINT ON (n:`{label}`) ASSERT n.id IS UNIQUE"
+SYNTAX_ERROR = "Neo.ClientError.Statement.SyntaxError"
+ALREADY_EXISTS_ERRORS = (
+    "Neo.ClientError.Schema.EquivalentSchemaRuleAlreadyExists",
+    "Neo.ClientError.Schema.ConstraintAlreadyExists",
+)
+LABELS = ("tv", "movie", "cast", "crew", "genre", "country", "company", "producer")
+
+
+def error_code(e):
+    """py2neo的ClientError带有Neo4j的错误码，其他异常返回None"""
+    return getattr(e, "code", None)
+
+
+def chunks(items, size):
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class GraphBatch:
+    """一批待写入的节点和关系
+
+    节点按(标签, id)去重，先加入的属性有效，与原来"不存在才插入"的语义相同。
+    set_node加入的节点不存在时创建，存在时更新属性，后加入的属性有效。
+    关系按(起点, 类型, 终点)去重。
+    """
+
+    def __init__(self):
+        # label -> {id: props}
+        self.nodes = defaultdict(dict)
+        self.updates = defaultdict(dict)
+        # (start_label, type, end_label) -> {(start_id, end_id): props}
+        self.rels = defaultdict(dict)
+
+    def __len__(self):
+        return sum(map(len, self.nodes.values()))+sum(map(len, self.updates.values())) + \
+            sum(map(len, self.rels.values()))
+
+    def add_node(self, label, id, **props):
+        self.nodes[label].setdefault(id, props)
+
+    def set_node(self, label, id, **props):
+        self.updates[label].setdefault(id, {}).update(props)
+
+    def add_rel(self, start_label, start_id, type, end_label, end_id, **props):
+        self.rels[start_label, type, end_label].setdefault(
+            (start_id, end_id), props)
+
+    def update(self, other):
+        """合并另一个GraphBatch"""
+        for label, nodes in other.nodes.items():
+            for id, props in nodes.items():
+                self.nodes[label].setdefault(id, props)
+        for label, nodes in other.updates.items():
+            for id, props in nodes.items():
+                self.set_node(label, id, **props)
+        for key, rels in other.rels.items():
+            for pair, props in rels.items():
+                self.rels[key].setdefault(pair, props)
+
+    def clear(self):
+        self.nodes.clear()
+        self.updates.clear()
+        self.rels.clear()
+
+
+class NodeCache:
+    """本次运行中已经确认存在于数据库中的节点，线程安全
+
+    重复出现的题材、国家和热门演员不需要再查询或写入数据库。
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ids = defaultdict(set)
+        self.hits = 0
+
+    def __contains__(self, key):
+        label, id = key
+        with self.lock:
+            return id in self.ids[label]
+
+    def missing(self, label, ids):
+        """返回ids中不在缓存里的部分"""
+        with self.lock:
+            known = self.ids[label]
+            ans = [id for id in ids if id not in known]
+            self.hits += len(ids)-len(ans)
+        return ans
+
+    def add(self, label, ids):
+        with self.lock:
+            self.ids[label].update(ids)
+
+
+class GraphLoader(ABC):
+    """图导入的接口
+
+    导入时依次调用ensure_constraints、existing_ids和write，结束时调用close。
+    """
+
+    def ensure_constraints(self, labels=LABELS):
+        pass
+
+    @abstractmethod
+    def existing_ids(self, label, ids):
+        """返回ids中已经存在的部分"""
+
+    @abstractmethod
+    def write(self, batch: GraphBatch):
+        pass
+
+    @abstractmethod
+    def get_nodes(self, label, ids):
+        """返回{id: 属性}，只包含已经存在的节点"""
+
+    def close(self):
+        pass
+
+
+class GraphQuery(ABC):
+    """图查询的接口，返回的都是TMDB的id"""
+
+    @abstractmethod
+    def co_stars(self, id, label="cast"):
+        """返回[(共同出演的演员id, 共同出演的影片数), ...]，按影片数降序"""
+
+    @abstractmethod
+    def shows_by_genre(self, genre_id, label="tv"):
+        """返回题材下所有影片的id"""
+
+    @abstractmethod
+    def shortest_path(self, start, end, label="cast"):
+        """返回两个演员之间经过影片的最短路径[(label, id), ...]，不连通时返回None"""
+
+
+class GraphBackend(GraphLoader, GraphQuery):
+    """既可以导入又可以查询的图后端"""
+
+
+class Neo4jLoader(GraphBackend):
+    """把GraphBatch写入py2neo的Graph
+
+    batch_size是每条UNWIND语句携带的行数。
+    """
+
+    def __init__(self, graph, batch_size=1000, cache=None):
+        self.graph = graph
+        self.batch_size = batch_size
+        self.cache = cache or NodeCache()
+
+    def ensure_constraints(self, labels=LABELS):
+        """为每个标签的id建立唯一约束，同时也会建立索引，MERGE和MATCH不再扫描所有节点
+
+        服务器不支持新语法时改用旧语法，连接或认证错误直接抛出。
+        """
+        cypher = CONSTRAINT_CYPHER
+        for label in labels:
+            try:
+                self._create_constraint(cypher, label)
+            except Exception as e:
+                if error_code(e) != SYNTAX_ERROR or cypher is CONSTRAINT_CYPHER_LEGACY:
+                    raise
+                logging.debug(f"{e}, fallback to legacy constraint syntax")
+                cypher = CONSTRAINT_CYPHER_LEGACY
+                self._create_constraint(cypher, label)
+
+    def _create_constraint(self, cypher, label):
+        """建立约束，约束已经存在时忽略"""
+        try:
+            self.graph.run(cypher.format(label=label))
+        except Exception as e:
+            if error_code(e) not in ALREADY_EXISTS_ERRORS:
+                raise
+            logging.debug(f"constraint on {label} already exists")
+
+    def existing_ids(self, label, ids):
+        """返回ids中已经存在于数据库的部分，只查询缓存中没有的id"""
+        ids = list(ids)
+        missing = self.cache.missing(label, ids)
+        found = set(ids).difference(missing)
+        if missing:
+            cursor = self.graph.run(EXISTS_CYPHER.format(label=label), ids=missing)
+            new = {record["id"] for record in cursor}
+            self.cache.add(label, new)
+            found |= new
+        return found
+
+    def write(self, batch: GraphBatch):
+        """在一个事务中先写入所有节点，再写入关系"""
+        start_time = time.perf_counter()
+        statements = 0
+        tx = self.graph.begin()
+        try:
+            for label, nodes in batch.nodes.items():
+                new = self.cache.missing(label, list(nodes))
+                for rows in chunks(({"id": id, "props": nodes[id]} for id in new),
+                                   self.batch_size):
+                    tx.run(NODE_CYPHER.format(label=label), rows=rows)
+                    statements += 1
+            for label, nodes in batch.updates.items():
+                for rows in chunks(({"id": id, "props": props} for id, props in nodes.items()),
+                                   self.batch_size):
+                    tx.run(UPDATE_CYPHER.format(label=label), rows=rows)
+                    statements += 1
+            for (start, type, end), rels in batch.rels.items():
+                for rows in chunks(({"start": s, "end": e, "props": props}
+                                    for (s, e), props in rels.items()), self.batch_size):
+                    tx.run(REL_CYPHER.format(start=start, type=type, end=end), rows=rows)
+                    statements += 1
+        except Exception:
+            tx.rollback()
+            raise
+        tx.commit()
+        for nodes in (batch.nodes, batch.updates):
+            for label, ids in nodes.items():
+                self.cache.add(label, ids)
+        logging.info(
+            f"wrote {len(batch)} nodes and relationships with {statements} statements "
+            f"in {time.perf_counter()-start_time:.2f}s, {self.cache.hits} node cache hits")
+
+    def get_nodes(self, label, ids):
+        cursor = self.graph.run(NODES_CYPHER.format(label=label), ids=list(ids))
+        return {record["id"]: dict(record["props"]) for record in cursor}
+
+    def co_stars(self, id, label="cast"):
+        cursor = self.graph.run(CO_STARS_CYPHER.format(label=label), id=id)
+        return [(record["id"], record["shared"]) for record in cursor]
+
+    def shows_by_genre(self, genre_id, label="tv"):
+        cursor = self.graph.run(SHOWS_BY_GENRE_CYPHER.format(label=label), id=genre_id)
+        return [record["id"] for record in cursor]
+
+    def shortest_path(self, start, end, label="cast"):
+        cursor = self.graph.run(SHORTEST_PATH_CYPHER.format(label=label), start=start, end=end)
+        for record in cursor:
+            return [tuple(key) for key in record["path"]]
+        return None
+
+
+def column_type(values):
+    """根据属性值推断neo4j-admin import的列类型"""
+    values = [v for v in values if v is not None]
+    if values and all(isinstance(v, bool) for v in values):
+        return "boolean"
+    if values and all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "long"
+    if values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return "double"
+    return "string"
+
+
+def header(key, values):
+    kind = column_type(values)
+    return key if kind == "string" else f"{key}:{kind}"
+
+
+class CsvExporter(GraphLoader):
+    """把GraphBatch导出为neo4j-admin import使用的CSV，不需要数据库
+
+    只实现GraphLoader的导入接口，不支持查询。所有批次在内存中去重，
+    close时每个标签写一个节点文件，每种(起点, 关系, 终点)写一个关系文件，并生成导入命令。
+    每个标签使用独立的ID空间，id另外保存为属性，与MERGE写入的图相同。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = GraphBatch()
+        self.lock = Lock()
+
+    def existing_ids(self, label, ids):
+        with self.lock:
+            return set(ids).intersection(self.data.nodes[label])
+
+    def write(self, batch: GraphBatch):
+        with self.lock:
+            self.data.update(batch)
+            for label, nodes in batch.updates.items():
+                for id, props in nodes.items():
+                    self.data.nodes[label].setdefault(id, {}).update(props)
+
+    def get_nodes(self, label, ids):
+        with self.lock:
+            nodes = self.data.nodes[label]
+            return {id: dict(nodes[id]) for id in ids if id in nodes}
+
+    def _write_nodes(self, label, nodes):
+        filename = self.path/f"nodes_{label}.csv"
+        keys = sorted({key for props in nodes.values() for key in props} - {"id"})
+        ids = list(nodes)
+        with open(filename, "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([f":ID({label})", header("id", ids),
+                             *(header(key, [p.get(key) for p in nodes.values()]) for key in keys),
+                             ":LABEL"])
+            for id, props in nodes.items():
+                writer.writerow([id, id, *(props.get(key) for key in keys), label])
+        return filename
+
+    def _write_rels(self, start, type, end, rels):
+        filename = self.path/f"rels_{start}_{type}_{end}.csv"
+        keys = sorted({key for props in rels.values() for key in props})
+        with open(filename, "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([f":START_ID({start})", f":END_ID({end})",
+                             *(header(key, [p.get(key) for p in rels.values()]) for key in keys),
+                             ":TYPE"])
+            for (s, e), props in rels.items():
+                writer.writerow([s, e, *(props.get(key) for key in keys), type])
+        return filename
+
+    def close(self):
+        """写出所有CSV，返回neo4j-admin import命令"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        node_files = [self._write_nodes(label, nodes)
+                      for label, nodes in self.data.nodes.items() if nodes]
+        rel_files = []
+        for (start, type, end), rels in self.data.rels.items():
+            # 端点不存在的关系（例如找不到的题材）会让导入失败，与MATCH的行为一致地丢弃
+            starts, ends = self.data.nodes[start], self.data.nodes[end]
+            rels = {pair: props for pair, props in rels.items()
+                    if pair[0] in starts and pair[1] in ends}
+            if rels:
+                rel_files.append(self._write_rels(start, type, end, rels))
+        command = " ".join([
+            "neo4j-admin database import full",
+            *(f"--nodes={f.name}" for f in node_files),
+            *(f"--relationships={f.name}" for f in rel_files),
+        ])
+        (self.path/"import_command.txt").write_text(command+"\n", encoding="utf8")
+        logging.info(
+            f"exported {len(node_files)} node files and {len(rel_files)} relationship files to {self.path}")
+        return command
@@ -0,0 +1,390 @@
+"""离线替身服务器
+
+模拟分集剧情网、TMDB API、尼尔森韩国收视率和微博指数接口，
+用于在没有网络的机器上测试爬虫和压测并发。
+fixtures目录下存在与请求路径同名的文件时直接返回该文件（录制的样例），
+否则按规则生成确定性的数据。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import math
+import mimetypes
+import random
+import re
+import time
+from collections import Counter
+from datetime import date, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", help="监听地址", default="127.0.0.1")
+parser.add_argument("--port", help="监听端口", default=8000, type=int)
+parser.add_argument("-f", "--fixtures", help="录制样例所在目录，例如tests/plots", type=Path)
+parser.add_argument("--latency", help="每个请求的基础延迟（秒）", default=0, type=float)
+parser.add_argument("--jitter", help="延迟的随机抖动（秒）", default=0, type=float)
+parser.add_argument("--error-rate", help="随机返回500的概率", default=0, type=float)
+parser.add_argument("--index-pages", help="剧集索引的页数，超过后返回404",
+                    default=3, type=int)
+parser.add_argument("--shows-per-page", help="每页索引中的剧集数", default=20, type=int)
+parser.add_argument("--pages-per-show", help="每部剧的分页数，超过后返回404",
+                    default=6, type=int)
+parser.add_argument("--episodes-per-page", help="每个分页中的集数", default=2, type=int)
+parser.add_argument("--popular-total", help="TMDB热门榜单的总条数", default=1000, type=int)
+parser.add_argument("--seed", help="随机数种子", default=0, type=int)
+parser.add_argument("-v", "--verbose", help="显示日志输出", action="store_true")
+
+PLOT_INDEX_RE = re.compile(r"^/\d+/list_\d+_(\d+)\.html$")
+PLOT_PAGE_RE = re.compile(r"^/\d+/(\d+)(?:_(\d+))?\.html$")
+TMDB_POPULAR_RE = re.compile(r"^/3/(tv|movie)/popular$")
+TMDB_GENRE_RE = re.compile(r"^/3/genre/(tv|movie)/list$")
+TMDB_SEARCH_RE = re.compile(r"^/3/search/(tv|movie|person)$")
+TMDB_DETAIL_RE = re.compile(
+    r"^/3/(tv|movie|person)/(\d+)(?:/(credits|external_ids))?$")
+TMDB_EXPORT_RE = re.compile(
+    r"^/p/exports/tv_series_ids_(\d{2})_(\d{2})_(\d{4})\.json\.gz$")
+NIELSEN_RE = re.compile(r"^/tv_terrestrial_day\.asp$")
+WEIBO_SEARCH_RE = re.compile(r"^/index/ajax/newindex/searchword$")
+WEIBO_DATA_RE = re.compile(r"^/index/ajax/newindex/getchartdata$")
+
+GENRES = [(18, "剧情"), (35, "喜剧"), (80, "犯罪"), (10749, "爱情"), (10765, "科幻")]
+COUNTRIES = ["KR", "CN", "JP", "US"]
+PAGE_SIZE = 20
+
+
+class Config:
+    def __init__(self, fixtures=None, latency=0, jitter=0, error_rate=0,
+                 index_pages=3, shows_per_page=20, pages_per_show=6,
+                 episodes_per_page=2, popular_total=1000, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.index_pages = index_pages
+        self.shows_per_page = shows_per_page
+        self.pages_per_show = pages_per_show
+        self.episodes_per_page = episodes_per_page
+        self.popular_total = popular_total
+        self.random = random.Random(seed)
+
+
+def show_name(show_id):
+    return f"剧集{show_id}"
+
+
+def plot_index_page(config, page, host):
+    if not 1 <= page <= config.index_pages:
+        return None
+    start = 10000+(page-1)*config.shows_per_page
+    # 与原网站一致，索引中使用绝对地址
+    links = "".join(
+        f'<li><a href="http://{host}/3/{i}.html">韩剧{show_name(i)}分集剧情</a></li>'
+        for i in range(start, start+config.shows_per_page)
+    )
+    html = f'<html><body><ul class="ico1">{links}</ul></body></html>'
+    return html.encode("gbk")
+
+
+def plot_page(config, show_id, page):
+    if not 1 <= page <= config.pages_per_show:
+        return None
+    first = (page-1)*config.episodes_per_page+1
+    paragraphs = []
+    for episode in range(first, first+config.episodes_per_page):
+        paragraphs.append(f"<h4>{show_name(show_id)}第{episode}集剧情介绍</h4>")
+        paragraphs.append(f"<p>第{episode}集的标题</p>")
+        paragraphs.append(
+            f"<p>{show_name(show_id)}第{episode}集的剧情，" + "主人公继续调查案件的真相。"*5 + "</p>")
+    html = f'<html><body><div id="AAA">{"".join(paragraphs)}</div></body></html>'
+    return html.encode("gbk")
+
+
+def tmdb_person(person_id):
+    return {
+        "id": person_id,
+        "name": f"演员{person_id}",
+        "popularity": person_id % 100/10,
+        "birthday": f"19{person_id % 90+10}-01-01",
+        "deathday": None,
+        "gender": person_id % 3,
+        "place_of_birth": "Seoul, South Korea",
+    }
+
+
+def tmdb_details(target, id):
+    if target == "person":
+        return tmdb_person(id)
+    genre_id, genre_name = GENRES[id % len(GENRES)]
+    country = COUNTRIES[id % len(COUNTRIES)]
+    return {
+        "id": id,
+        "name" if target == "tv" else "title": f"{target}{id}",
+        "original_name": f"{target}{id}",
+        "popularity": round(1000/(id % 997+1), 3),
+        "vote_average": id % 10,
+        "genres": [{"id": genre_id, "name": genre_name}],
+        "origin_country": [country],
+        "production_companies": [{"id": id % 50, "name": f"公司{id % 50}", "origin_country": country}],
+        "created_by": [{"id": 900000+id % 30, "name": f"制作人{id % 30}", "gender": 1}],
+    }
+
+
+def tmdb_credits(id):
+    # 相邻的剧共享一部分演员，便于测试去重
+    return {
+        "id": id,
+        "cast": [{"id": 500000+(id+k) % 200, "character": f"角色{k}", "order": k} for k in range(5)],
+        "crew": [{"id": 700000+id % 40, "job": "Director"}],
+    }
+
+
+def tmdb_external_ids(id):
+    return {"id": id, "imdb_id": f"tt{id:07d}"}
+
+
+def tmdb_popular(config, target, page):
+    total_pages = math.ceil(config.popular_total/PAGE_SIZE)
+    start = (page-1)*PAGE_SIZE
+    ids = range(start+1, min(start+PAGE_SIZE, config.popular_total)+1)
+    return {
+        "page": page,
+        "total_pages": total_pages,
+        "total_results": config.popular_total,
+        "results": [{"id": i, "popularity": round(1000/i, 3), "genre_ids": [GENRES[i % len(GENRES)][0]]} for i in ids],
+    }
+
+
+def tmdb_export(cur_date):
+    """生成与TMDB每日导出格式相同的gzip文件"""
+    offset = cur_date.toordinal() % 7
+    lines = (
+        json.dumps({"id": i, "original_name": f"tv{i}",
+                    "popularity": round(1000/i+offset, 3)})
+        for i in range(1, 2001)
+    )
+    # mtime固定，同一天的导出每次内容相同，断点续传才能拼接
+    return gzip.compress(("\n".join(lines)+"\n").encode("utf8"), mtime=0)
+
+
+def nielsen_page(begin_date):
+    rows = "".join(
+        f"<tr><td>{i}</td><td>KBS</td><td>节目{i}</td><td>{20-i/2:.1f}</td></tr>" for i in range(1, 21))
+    view_rows = "".join(
+        f"<tr><td>{i}</td><td>KBS</td><td>节目{i}</td><td>{(21-i)*10000:,}</td></tr>" for i in range(1, 21))
+    return (
+        f'<html><body><p>{begin_date}</p>'
+        f'<table class="ranking_tb"><tr class="head"><td>a</td><td>b</td></tr>{rows}</table>'
+        f'<table class="ranking_tb"><tr class="head"><td>a</td><td>b</td></tr>{view_rows}</table>'
+        f'</body></html>'
+    ).encode("utf8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def send(self, status, body=b"", content_type="text/html"):
+        headers = {}
+        if status == 200:
+            # 生成的内容是确定性的，用内容摘要作为ETag，支持条件请求
+            headers["ETag"] = f'"{hashlib.sha1(body).hexdigest()}"'
+            headers["Last-Modified"] = formatdate(self.server.last_modified, usegmt=True)
+            if self.not_modified(headers["ETag"]):
+                status, body = 304, b""
+        self.server.count(status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag):
+        """If-None-Match优先于If-Modified-Since"""
+        if "If-None-Match" in self.headers:
+            return etag in (tag.strip() for tag in self.headers["If-None-Match"].split(","))
+        since = self.headers.get("If-Modified-Since")
+        if not since:
+            return False
+        try:
+            return parsedate_to_datetime(since).timestamp() >= self.server.last_modified
+        except (TypeError, ValueError):
+            return False
+
+    def send_range(self, body, content_type):
+        """支持"Range: bytes=N-"形式的断点续传请求"""
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if not match:
+            return self.send(200, body, content_type)
+        start = int(match.group(1))
+        if start >= len(body):
+            return self.send(416, b"")
+        self.server.count(206)
+        self.send_response(206)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Range", f"bytes {start}-{len(body)-1}/{len(body)}")
+        self.send_header("Content-Length", str(len(body)-start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def send_json(self, d):
+        self.send(200, json.dumps(d, ensure_ascii=False).encode("utf8"),
+                  "application/json;charset=utf-8")
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf8"))
+        self.handle_request({k: v[0] for k, v in form.items()})
+
+    def handle_request(self, form=None):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        config = self.config
+        delay = config.latency+config.random.uniform(0, config.jitter)
+        if delay:
+            time.sleep(delay)
+        if url.path == "/__stats__":
+            return self.send_json(self.server.stats())
+        if config.random.random() < config.error_rate:
+            return self.send(500, b"Internal Server Error")
+        if config.fixtures:
+            fixture = config.fixtures/url.path.lstrip("/")
+            if fixture.is_file():
+                content_type = mimetypes.guess_type(
+                    fixture.name)[0] or "text/html"
+                return self.send(200, fixture.read_bytes(), content_type)
+        self.route(url.path, query, form or {})
+
+    def route(self, path, query, form):
+        config = self.config
+        match = PLOT_INDEX_RE.match(path)
+        if match:
+            host = self.headers.get("Host", "%s:%s" % self.server.server_address[:2])
+            return self.send_or_404(plot_index_page(config, int(match.group(1)), host), "text/html;charset=gbk")
+        match = PLOT_PAGE_RE.match(path)
+        if match:
+            page = int(match.group(2) or 1)
+            return self.send_or_404(plot_page(config, int(match.group(1)), page), "text/html;charset=gbk")
+        match = TMDB_POPULAR_RE.match(path)
+        if match:
+            return self.send_json(tmdb_popular(config, match.group(1), int(query.get("page", 1))))
+        match = TMDB_GENRE_RE.match(path)
+        if match:
+            return self.send_json({"genres": [{"id": i, "name": n} for i, n in GENRES]})
+        match = TMDB_SEARCH_RE.match(path)
+        if match:
+            q = query.get("query", "")
+            id = sum(map(ord, q)) % 100000+1
+            return self.send_json({"page": 1, "total_pages": 1, "total_results": 1,
+                                   "results": [{"id": id, "name": q}]})
+        match = TMDB_DETAIL_RE.match(path)
+        if match:
+            target, id, sub = match.group(1), int(match.group(2)), match.group(3)
+            if sub == "credits":
+                return self.send_json(tmdb_credits(id))
+            elif sub == "external_ids":
+                return self.send_json(tmdb_external_ids(id))
+            details = tmdb_details(target, id)
+            for part in filter(None, query.get("append_to_response", "").split(",")):
+                if part == "credits":
+                    details["credits"] = tmdb_credits(id)
+                elif part == "external_ids":
+                    details["external_ids"] = tmdb_external_ids(id)
+            return self.send_json(details)
+        match = TMDB_EXPORT_RE.match(path)
+        if match:
+            month, day, year = map(int, match.groups())
+            return self.send_range(tmdb_export(date(year, month, day)), "application/octet-stream")
+        if NIELSEN_RE.match(path):
+            return self.send(200, nielsen_page(query.get("begin_date", "")), "text/html;charset=utf-8")
+        if WEIBO_SEARCH_RE.match(path):
+            word = form.get("word", "")
+            if not word:
+                return self.send_json({"code": 101})
+            return self.send_json({"code": 100, "html": f'<li wid="{sum(map(ord, word))}">{word}</li>'})
+        if WEIBO_DATA_RE.match(path):
+            start = date(2020, 1, 1)
+            x = [str(start+timedelta(days=n)) for n in range(30)]
+            s = [str(1000+n*10) for n in range(30)]
+            return self.send_json({"data": [{"trend": {"x": x, "s": s}}]})
+        self.send(404, b"Not Found")
+
+    def send_or_404(self, body, content_type):
+        if body is None:
+            self.send(404, b"Not Found")
+        else:
+            self.send(200, body, content_type)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None):
+        super().__init__((host, port), Handler)
+        self.config = config or Config()
+        self.counter = Counter()
+        self.lock = Lock()
+        self.thread = None
+        # 所有生成的页面都视为在服务器启动时修改
+        self.last_modified = int(time.time())
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, status):
+        """按状态码统计请求数"""
+        with self.lock:
+            self.counter[str(status)] += 1
+            self.counter["total"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counter)
+
+    def start(self):
+        """在后台线程中运行，主要用于测试"""
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    arg = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if arg.verbose else logging.INFO)
+    config = Config(arg.fixtures, arg.latency, arg.jitter, arg.error_rate,
+                    arg.index_pages, arg.shows_per_page, arg.pages_per_show,
+                    arg.episodes_per_page, arg.popular_total, arg.seed)
+    server = StandInServer(arg.host, arg.port, config)
+    print(f"替身服务器运行在{server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,300 @@
+"""内嵌的内存图后端
+
+节点编号为连续整数，邻接表以CSR格式保存在紧凑的整数数组中，
+可以保存为单个文件并通过mmap零拷贝加载。不需要Neo4j即可在进程内完成
+共同出演、题材下的影片和演员之间最短路径等查询。
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections import Counter, deque
+from threading import Lock
+
+from graph_loader import GraphBackend, GraphBatch
+
+MAGIC = b"TVGRAPH1"
+ARRAY_NAMES = ("edge_src", "edge_type", "edge_dst",
+               "out_offsets", "out_edges", "in_offsets", "in_edges")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("filename", help="topN_tv&cast.py --graph-file保存的图文件")
+subparsers = parser.add_subparsers(dest="command", required=True)
+costars_parser = subparsers.add_parser("costars", help="与演员共同出演的演员")
+costars_parser.add_argument("id", type=int)
+costars_parser.add_argument("-n", "--number", help="输出的个数", default=10, type=int)
+genre_parser = subparsers.add_parser("genre", help="题材下的影片")
+genre_parser.add_argument("id", type=int)
+genre_parser.add_argument("-t", "--target", default="tv", choices=("tv", "movie"))
+path_parser = subparsers.add_parser("path", help="两个演员之间的最短路径")
+path_parser.add_argument("start", type=int)
+path_parser.add_argument("end", type=int)
+
+
+class MemoryGraph(GraphBackend):
+    """整数索引的内存图
+
+    写入时节点和边追加到列表中，第一次查询时构建CSR数组。
+    filename不为None时，close会把图保存到该文件。
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = Lock()
+        # 节点：编号 -> (label, id)和属性
+        self.keys = []
+        self.props = []
+        self.index = {}
+        self.types = []
+        self.type_index = {}
+        # 边：编号 -> (起点, 类型, 终点)和属性
+        self.edges = []
+        self.edge_props = []
+        self.edge_index = {}
+        self.arrays = None
+        self.view = None
+        self.mm = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    # 写入接口
+
+    def existing_ids(self, label, ids):
+        with self.lock:
+            return {id for id in ids if (label, id) in self.index}
+
+    def _node(self, label, id, props=None):
+        """返回节点编号，不存在时创建，调用时必须持有锁"""
+        key = (label, id)
+        node = self.index.get(key)
+        if node is None:
+            node = self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.props.append(dict(props or {}))
+        return node
+
+    def write(self, batch: GraphBatch):
+        with self.lock:
+            self._thaw()
+            for label, nodes in batch.nodes.items():
+                for id, props in nodes.items():
+                    self._node(label, id, props)
+            for label, nodes in batch.updates.items():
+                for id, props in nodes.items():
+                    self.props[self._node(label, id)].update(props)
+            for (start, type, end), rels in batch.rels.items():
+                if type not in self.type_index:
+                    self.type_index[type] = len(self.types)
+                    self.types.append(type)
+                t = self.type_index[type]
+                for (s, e), props in rels.items():
+                    # 与MATCH一样，端点不存在时丢弃这条关系
+                    src = self.index.get((start, s))
+                    dst = self.index.get((end, e))
+                    if src is None or dst is None or (src, t, dst) in self.edge_index:
+                        continue
+                    self.edge_index[src, t, dst] = len(self.edges)
+                    self.edges.append((src, t, dst))
+                    self.edge_props.append(props)
+            self.arrays = None
+
+    def get_nodes(self, label, ids):
+        with self.lock:
+            return {id: dict(self.props[self.index[label, id]])
+                    for id in ids if (label, id) in self.index}
+
+    def close(self):
+        if self.filename:
+            self.save(self.filename)
+        with self.lock:
+            self._release()
+
+    # CSR数组
+
+    def _build(self):
+        """由边列表构建出边和入边的CSR数组"""
+        n = len(self.keys)
+        arrays = {name: array("q") for name in ARRAY_NAMES}
+        for src, t, dst in self.edges:
+            arrays["edge_src"].append(src)
+            arrays["edge_type"].append(t)
+            arrays["edge_dst"].append(dst)
+        for direction, column in (("out", "edge_src"), ("in", "edge_dst")):
+            counts = [0]*(n+1)
+            for node in arrays[column]:
+                counts[node+1] += 1
+            for i in range(n):
+                counts[i+1] += counts[i]
+            offsets = array("q", counts)
+            edges = array("q", bytes(8*len(self.edges)))
+            position = list(counts[:-1])
+            for e, node in enumerate(arrays[column]):
+                edges[position[node]] = e
+                position[node] += 1
+            arrays[f"{direction}_offsets"] = offsets
+            arrays[f"{direction}_edges"] = edges
+        self.arrays = arrays
+
+    def _csr(self):
+        with self.lock:
+            if self.arrays is None:
+                self._build()
+            return self.arrays
+
+    def _thaw(self):
+        """从mmap加载的图在写入前转换回可修改的列表，调用时必须持有锁"""
+        if self.mm is None:
+            return
+        a = self.arrays
+        self.edges = list(zip(a["edge_src"], a["edge_type"], a["edge_dst"]))
+        self.edge_index = {edge: i for i, edge in enumerate(self.edges)}
+        self._release()
+
+    def _release(self):
+        """释放引用mmap的所有memoryview后关闭文件，调用时必须持有锁"""
+        if self.mm is None:
+            return
+        for view in self.arrays.values():
+            view.release()
+        self.view.release()
+        self.arrays = None
+        self.mm.close()
+        self.mm = None
+
+    def _neighbors(self, node, types=None, direction="out"):
+        a = self._csr()
+        offsets, edges = a[f"{direction}_offsets"], a[f"{direction}_edges"]
+        other = a["edge_dst"] if direction == "out" else a["edge_src"]
+        edge_type = a["edge_type"]
+        for k in range(offsets[node], offsets[node+1]):
+            e = edges[k]
+            if types is None or edge_type[e] in types:
+                yield other[e]
+
+    def _types(self, *names):
+        return {self.type_index[name] for name in names if name in self.type_index}
+
+    # 持久化
+
+    def save(self, filename):
+        """保存为单个文件：魔数、头部长度、JSON头部，之后是8字节对齐的各个数组"""
+        arrays = self._csr()
+        header = json.dumps({
+            "keys": self.keys,
+            "props": self.props,
+            "types": self.types,
+            "edge_props": self.edge_props,
+            "lengths": [len(arrays[name]) for name in ARRAY_NAMES],
+        }, ensure_ascii=False).encode("utf8")
+        header += b" "*(-len(header) % 8)
+        # 先写入临时文件再替换，保存到正在mmap的文件时不会破坏映射中的数据
+        temp = f"{filename}.tmp"
+        with open(temp, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<q", len(header)))
+            f.write(header)
+            for name in ARRAY_NAMES:
+                f.write(arrays[name].tobytes())
+        os.replace(temp, filename)
+
+    @classmethod
+    def open(cls, filename):
+        """文件存在时加载，否则创建空图，close时都会保存到filename"""
+        graph = cls.load(filename) if os.path.exists(filename) else cls()
+        graph.filename = filename
+        return graph
+
+    @classmethod
+    def load(cls, filename):
+        """用mmap打开保存的图，数组直接引用文件内容而不复制"""
+        graph = cls()
+        with open(filename, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:8] != MAGIC:
+            mm.close()
+            raise ValueError(f"{filename} is not a graph file")
+        header_len, = struct.unpack("<q", mm[8:16])
+        header = json.loads(mm[16:16+header_len])
+        graph.keys = [tuple(key) for key in header["keys"]]
+        graph.index = {key: i for i, key in enumerate(graph.keys)}
+        graph.props = header["props"]
+        graph.types = header["types"]
+        graph.type_index = {t: i for i, t in enumerate(graph.types)}
+        graph.edge_props = header["edge_props"]
+        offset = 16+header_len
+        view = memoryview(mm)
+        graph.arrays = {}
+        for name, length in zip(ARRAY_NAMES, header["lengths"]):
+            graph.arrays[name] = view[offset:offset+8*length].cast("q")
+            offset += 8*length
+        graph.view = view
+        graph.mm = mm
+        return graph
+
+    # 查询
+
+    def node(self, label, id):
+        """返回节点属性，不存在时返回None"""
+        node = self.index.get((label, id))
+        return None if node is None else dict(self.props[node], id=id)
+
+    def co_stars(self, id, label="cast"):
+        types = self._types(label)
+        actor = self.index.get((label, id))
+        if actor is None:
+            return []
+        counter = Counter()
+        for show in self._neighbors(actor, types, "in"):
+            for other in self._neighbors(show, types, "out"):
+                if other != actor:
+                    counter[self.keys[other][1]] += 1
+        return counter.most_common()
+
+    def shows_by_genre(self, genre_id, label="tv"):
+        genre = self.index.get(("genre", genre_id))
+        if genre is None:
+            return []
+        return sorted(self.keys[show][1] for show in self._neighbors(genre, self._types("is"), "in")
+                      if self.keys[show][0] == label)
+
+    def shortest_path(self, start, end, label="cast"):
+        source = self.index.get((label, start))
+        target = self.index.get((label, end))
+        if source is None or target is None:
+            return None
+        types = self._types(label)
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(self.keys[node])
+                    node = previous[node]
+                return path[::-1]
+            # 演员和影片之间的关系按无向边处理
+            for direction in ("out", "in"):
+                for other in self._neighbors(node, types, direction):
+                    if other not in previous:
+                        previous[other] = node
+                        queue.append(other)
+        return None
+
+
+if __name__ == "__main__":
+    arg = parser.parse_args()
+    graph = MemoryGraph.load(arg.filename)
+    if arg.command == "costars":
+        for id, shared in graph.co_stars(arg.id)[:arg.number]:
+            print(graph.node("cast", id)["name"], shared)
+    elif arg.command == "genre":
+        for id in graph.shows_by_genre(arg.id, arg.target):
+            print(id, graph.node(arg.target, id)["name"])
+    else:
+        path = graph.shortest_path(arg.start, arg.end)
+        print(" -> ".join(graph.node(*key)["name"] for key in path) if path else "没有路径")
+    graph.close()
@@ -1,11 +1,12 @@
 import argparse
-import requests
 import re
 import pandas as pd
 import logging
+from rate_limit import RateLimitedSession
 
-SEARCH_API_URL = "https://data.weibo.com/index/ajax/newindex/searchword"
-DATA_API_URL = "https://data.weibo.com/index/ajax/newindex/getchartdata"
+API_HOST = "https://data.weibo.com"
+SEARCH_API_URL = "/index/ajax/newindex/searchword"
+DATA_API_URL = "/index/ajax/newindex/getchartdata"
 DATE_GROUP_CHOICES = ("1hour", "1day", "1month", "3month")
 WID_RE = re.compile(r'wid="(\d+)"')
 
@@ -24,15 +25,13 @@ class EmptyHTML(Exception):
 
 
 def make_session(headers):
-    s = requests.Session()
-    s.headers.update(headers)
-    return s
+    return RateLimitedSession(headers=headers)
 
 
-def search_word(word, session=None):
+def search_word(word, session=None, host=API_HOST):
     logging.info(f"查找{word}关键字的wid...")
     s = session or make_session(headers)
-    r = s.post(SEARCH_API_URL, data={
+    r = s.post(host+SEARCH_API_URL, data={
         "word": word
     })
     d = r.json()
@@ -48,10 +47,10 @@ def search_word(word, session=None):
             return WID_RE.search(html).group(1)
 
 
-def get_chart_data(wid, dateGroup, session=None):
+def get_chart_data(wid, dateGroup, session=None, host=API_HOST):
     logging.info(f"查找{wid}时间范围为{dateGroup}的数据...")
     s = session or make_session(headers)
-    r = s.post(DATA_API_URL, data={
+    r = s.post(host+DATA_API_URL, data={
         "wid": wid,
         "dateGroup": dateGroup
     })
@@ -66,15 +65,17 @@ parser.add_argument("dateGroup", help="查询日期范围", choices=DATE_GROUP_C
 parser.add_argument("-o", "--output", help="输出的文件名",
                     default="data\micro_index_{word}_{dateGroup}.csv")
 parser.add_argument("-v", "--verbose", help="显示日志输出", action="store_true")
+parser.add_argument("--host", help="微博指数接口的主机，可指向本地替身服务器",
+                    default=API_HOST)
 
 if __name__ == "__main__":
     arg = parser.parse_args()
     if arg.verbose:
         logging.basicConfig(level=logging.INFO)
     s = make_session(headers)
-    wid = search_word(arg.word, s)
+    wid = search_word(arg.word, s, arg.host)
     logging.info(f"{arg.word}关键字wid是{wid}.")
-    data = get_chart_data(wid, arg.dateGroup, s)
+    data = get_chart_data(wid, arg.dateGroup, s, arg.host)
     df = pd.DataFrame(list(data), columns=["x", "s"])
     filename = arg.output.format(word=arg.word, dateGroup=arg.dateGroup)
     logging.info(f"写入{filename}中...")
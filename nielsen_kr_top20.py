@@ -5,11 +5,11 @@ from datetime import date, timedelta
 import logging
 import sqlite3
 from collections import defaultdict
-import time
 import pandas as pd
 import re
 from functools import partial
 from concurrent import futures
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession
 
 parser = argparse.ArgumentParser()
 parser.add_argument("start", help="爬虫开始日期", default=str(
@@ -21,8 +21,13 @@ parser.add_argument("area", help="地区编码，01表示大都市区，00表示
 parser.add_argument("-d", "--db", help="数据库位置", default="tv.db")
 parser.add_argument("-v", "--verbose", help="显示日志输出", action="store_true")
 parser.add_argument("-t", "--thread", help="并行线程数", default=8, type=int)
+parser.add_argument("-r", "--rate", help="每秒请求数的初始值，之后根据服务器响应自动调整",
+                    default=10, type=float)
+parser.add_argument("--retry", help="连接失败重传数", type=int, default=3)
 
 DOWNLOAD_URL = "http://www.nielsenkorea.co.kr/tv_terrestrial_day.asp"
+parser.add_argument("--url", help="收视率页面URL，可指向本地替身服务器",
+                    default=DOWNLOAD_URL)
 
 REMOVE_COMMA_RE = re.compile(",")
 remove_comma = partial(REMOVE_COMMA_RE.sub, "")
@@ -38,9 +43,9 @@ SCHEMA = """
     """
 
 
-def download(url, cur_date: date, area)->str:
+def download(url, cur_date: date, area, session=requests)->str:
     logging.debug(f"正在下载URL: {url}...")
-    r = requests.get(url, params={
+    r = session.get(url, params={
         "menu": "Tit_1",
         "sub_menu": "1_1",
         "area": area,
@@ -77,17 +82,22 @@ def parse_html(s_html):
 
 
 class Scheduler:
-    def __init__(self, start, end, area, db_fname, thread):
+    def __init__(self, start, end, area, db_fname, thread, url=DOWNLOAD_URL,
+                 rate=10, retry=3):
         self.start = start
+        self.url = url
+        # 所有线程共享一个限速器，代替原来每个请求固定等待0.1秒
+        self.session = RateLimitedSession(
+            RateLimiter(rate), RetryPolicy(retry))
         self.end = end
         self.area = area
         self.conn = sqlite3.connect(db_fname)
         self.thread = thread
 
     def download_date(self, cur_date):
-        df = parse_html(download(DOWNLOAD_URL, cur_date, self.area))
+        df = parse_html(
+            download(self.url, cur_date, self.area, self.session))
         df["record_date"] = cur_date
-        time.sleep(.1)
         return df
 
     def crawler(self):
@@ -105,5 +115,6 @@ if __name__ == "__main__":
     arg = parser.parse_args()
     if arg.verbose:
         logging.basicConfig(level=logging.DEBUG)
-    scheduler = Scheduler(arg.start, arg.end, arg.area, arg.db, arg.thread)
+    scheduler = Scheduler(arg.start, arg.end, arg.area,
+                          arg.db, arg.thread, arg.url, arg.rate, arg.retry)
     scheduler.crawler()
@@ -0,0 +1,208 @@
+import argparse
+import copy
+import cProfile
+import json
+import logging
+import platform
+import pstats
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+from lxml import etree
+
+from plot_crawler import (EPISODE_RE, SHOW_NAME_RE, MainPageParser,
+                          PlotParser, Urls, get_full_content)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-p", "--path", help="HTML样例所在目录",
+                    default="tests/plots", type=Path)
+parser.add_argument("-r", "--repeat", help="每项测试重复的轮数", default=20, type=int)
+parser.add_argument("-s", "--scale", help="合成大页面时正文重复的倍数",
+                    default=20, type=int)
+parser.add_argument("-o", "--output", help="结果JSON文件名，支持使用{commit}格式化",
+                    default="bench_{commit}.json")
+parser.add_argument("-c", "--compare", help="与之前保存的结果JSON比较", type=Path)
+parser.add_argument("--top", help="输出耗时最多的函数个数", default=15, type=int)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_fixtures(path: Path):
+    """读取目录下所有gbk编码的剧情页"""
+    return {f.name: f.read_text(encoding="gbk") for f in sorted(path.glob("*.html"))}
+
+
+def make_large_page(html, scale):
+    """把正文段落重复scale次，合成一个更大的剧情页"""
+    dom = etree.HTML(html)
+    for div in dom.xpath("//div[@id='AAA']"):
+        children = list(div)
+        for _ in range(scale-1):
+            div.extend(copy.deepcopy(child) for child in children)
+    return etree.tostring(dom, encoding="unicode")
+
+
+def make_main_page(names, scale):
+    """用样例中的剧名合成一个索引页"""
+    links = "".join(
+        f'<li><a href="http://www.bjxyxd.com/3/{i}.html">韩剧{name}分集剧情</a></li>'
+        for i, name in enumerate(names*scale)
+    )
+    return f'<html><body><ul class="ico1">{links}</ul></body></html>'
+
+
+def measure(func, repeat):
+    """运行func repeat次，返回(平均耗时, 返回值, 峰值内存)
+
+    tracemalloc会明显拖慢运行速度，所以峰值内存单独运行一次测量。
+    """
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        ans = func()
+    elapsed = (time.perf_counter()-start_time)/repeat
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, ans, peak
+
+
+def bench_plot_parser(pages, repeat):
+    def run():
+        plots = 0
+        for name, html in pages.items():
+            plots += sum(1 for _ in PlotParser("bench",
+                                               html, name, Urls()).parse_html())
+        return plots
+
+    elapsed, plots, peak = measure(run, repeat)
+    return {
+        "pages": len(pages),
+        "plots": plots,
+        "seconds": elapsed,
+        "pages_per_sec": len(pages)/elapsed,
+        "plots_per_sec": plots/elapsed,
+        "peak_memory": peak,
+    }
+
+
+def bench_main_page(html, repeat):
+    def run():
+        return sum(1 for show in MainPageParser(html).get_shows() if show)
+
+    elapsed, shows, peak = measure(run, repeat)
+    return {
+        "shows": shows,
+        "seconds": elapsed,
+        "shows_per_sec": shows/elapsed,
+        "peak_memory": peak,
+    }
+
+
+def bench_regex(pattern, texts, repeat):
+    def run():
+        return sum(1 for text in texts if pattern.match(text))
+
+    elapsed, matched, peak = measure(run, repeat)
+    return {
+        "lines": len(texts),
+        "matched": matched,
+        "seconds": elapsed,
+        "lines_per_sec": len(texts)/elapsed,
+        "peak_memory": peak,
+    }
+
+
+def profile_functions(pages, top):
+    """用cProfile统计解析过程中各函数的累计耗时"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for name, html in pages.items():
+        for _ in PlotParser("bench", html, name, Urls()).parse_html():
+            pass
+    profiler.disable()
+    stats = pstats.Stats(profiler).stats
+    rows = [
+        {
+            "function": f"{Path(filename).name}:{lineno}:{func}",
+            "calls": nc,
+            "tottime": tt,
+            "cumtime": ct,
+        }
+        for (filename, lineno, func), (cc, nc, tt, ct, callers) in stats.items()
+    ]
+    rows.sort(key=lambda row: row["cumtime"], reverse=True)
+    return rows[:top]
+
+
+def compare(old, new):
+    """打印新旧两次结果中各项吞吐量的变化"""
+    for name, result in new["results"].items():
+        old_result = old["results"].get(name)
+        if not old_result:
+            continue
+        for key, value in result.items():
+            if key.endswith("_per_sec") and old_result.get(key):
+                ratio = value/old_result[key]
+                print(
+                    f"{name}.{key}: {old_result[key]:.1f} -> {value:.1f} ({ratio:.2f}x)")
+
+
+def run_benchmarks(path, repeat, scale, top):
+    pages = load_fixtures(path)
+    large_pages = {name: make_large_page(html, scale)
+                   for name, html in pages.items()}
+    texts = [
+        get_full_content(dom)
+        for html in pages.values()
+        for dom in etree.HTML(html).xpath("//div[@id='AAA']/p | //h4")
+    ]
+    names = [f"剧集{i}" for i in range(len(pages))]
+    main_page = make_main_page(names, scale)
+    titles = [f"韩剧{name}分集剧情" for name in names*scale]
+
+    return {
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "scale": scale,
+        "results": {
+            "plot_parser": bench_plot_parser(pages, repeat),
+            "plot_parser_large": bench_plot_parser(large_pages, max(repeat//scale, 1)),
+            "main_page_parser": bench_main_page(main_page, repeat),
+            "episode_re": bench_regex(EPISODE_RE, texts, repeat),
+            "show_name_re": bench_regex(SHOW_NAME_RE, titles, repeat),
+        },
+        "profile": profile_functions(pages, top),
+    }
+
+
+if __name__ == "__main__":
+    arg = parser.parse_args()
+    # 基准测试时关闭日志，避免IO影响计时
+    logging.disable(logging.CRITICAL)
+    res = run_benchmarks(arg.path, arg.repeat, arg.scale, arg.top)
+    for name, result in res["results"].items():
+        print(name, json.dumps(result, ensure_ascii=False))
+    for row in res["profile"]:
+        print(
+            f"{row['cumtime']:8.4f}s {row['calls']:8d} {row['function']}")
+    filename = arg.output.format(commit=res["commit"])
+    with open(filename, "w", encoding="utf8") as f:
+        json.dump(res, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入{filename}")
+    if arg.compare:
+        with open(arg.compare, "r", encoding="utf8") as f:
+            compare(json.load(f), res)
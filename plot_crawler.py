@@ -1,18 +1,28 @@
 import requests
+import aiohttp
+import asyncio
 from lxml import etree
 import logging
 from collections import namedtuple
 import re
+import zlib
+import hashlib
 from itertools import dropwhile, takewhile, tee, chain
 import sqlite3
-from time import sleep
+from time import sleep, time
 from concurrent import futures
 import queue
 from functools import wraps
-from threading import Lock
+from threading import Lock, Thread, Condition
+import argparse
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession, async_get
 
 Plot_para = namedtuple(
     "Plot_para", ("show_name", "episode", "title", "detail", "url"))
+# 预先提取的节点记录，episode是该行作为分集行时的集数，不是分集行时为空字符串
+Line = namedtuple("Line", ("text", "tag", "episode"))
+CachedResponse = namedtuple(
+    "CachedResponse", ("body", "etag", "last_modified", "fresh"))
 
 # 预编译常用正则表达式
 
@@ -22,25 +32,49 @@ EXTRACT_EPISODE_RE = re.compile(r"第?([\d一二三四五六七八九十百]+)[
 SHOW_NAME_RE = re.compile(
     r"(?:韩剧)?(.*?)(韩剧|剧情|分集|简介|介绍|(?:第?\d+(?:-\d+)?[集回])|大结局)+.*")
 TITLE_LENGTH = 35
+INDEX_URL = "http://www.bjxyxd.com/3/list_3.html"
 
 
 def get_full_content(dom):
     return "".join(dom.xpath(".//text()")).strip()
 
 
+def compile_lines(doms):
+    """把节点一次性转换成Line记录
+
+    每个节点只提取一次文本，并在同一遍中判断是否为分集行，
+    之后的分类只需要比较记录中的字段。
+    """
+    lines = []
+    for dom in doms:
+        text = get_full_content(dom)
+        match = EPISODE_RE.match(text) if len(text) < TITLE_LENGTH else None
+        episode = match.group(1) if match and match.group(1) else ""
+        lines.append(Line(text, dom.tag, episode))
+    return lines
+
+
+def as_line(r):
+    return r if isinstance(r, Line) else compile_lines([r])[0]
+
+
 def debug_tool(func):
 
     def dom2text(dom):
         if isinstance(dom, etree._Element):
             return get_full_content(dom)
+        elif isinstance(dom, Line):
+            return dom.text
         else:
             return dom
 
     @wraps(func)
     def inner(*args, **kwargs):
         ans = func(*args, **kwargs)
-        logging.debug(
-            f"{func.__name__} {list(map(dom2text, args))} {kwargs} {ans}")
+        # 格式化参数的代价很高，只在开启DEBUG时进行
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                f"{func.__name__} {list(map(dom2text, args))} {kwargs} {ans}")
         return ans
     return inner
 
@@ -50,11 +84,25 @@ class PageNotFoundException(Exception):
 
 
 class Urls:
-    def __init__(self):
+    """任务队列
+
+    todo中的元素是(url, show_name)，done中是已经完成的url。
+    失败的任务按指数退避重试，fail记录每个任务的(失败次数, 下次重试时间)。
+    producers是仍在向队列中添加任务的生产者数量，队列为空但还有生产者时，
+    wait_url会等待新任务而不是直接结束。
+    """
+
+    resumed = False
+
+    def __init__(self, max_retry=3, backoff=2.0):
         self.todo = set()
         self.done = set()
-        self.fail = queue.Queue()
+        self.fail = {}
         self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.producers = 0
+        self.max_retry = max_retry
+        self.backoff = backoff
 
     def get_url(self):
         self.lock.acquire()
@@ -63,9 +111,33 @@ class Urls:
         self.lock.release()
         return url
 
-    def done_url(self, url):
+    def wait_url(self):
+        """取出一个任务，队列为空时等待生产者，全部结束后返回None"""
+        with self.cond:
+            while not self.todo and self.producers:
+                self.cond.wait()
+            url = self.todo.pop() if self.todo else None
+        logging.debug(f"wait_url returns {url}.")
+        return url
+
+    def start_producer(self):
+        with self.cond:
+            self.producers += 1
+
+    def stop_producer(self):
+        with self.cond:
+            self.producers -= 1
+            self.cond.notify_all()
+
+    @property
+    def producing(self):
+        return self.producers > 0
+
+    def done_url(self, item):
+        url, _ = item
         self.lock.acquire()
         self.done.add(url)
+        self.fail.pop(item, None)
         self.lock.release()
         logging.debug(f"{url} is done.")
 
@@ -75,15 +147,45 @@ class Urls:
         self.lock.release()
         return flag
 
-    def fail_url(self, url):
-        self.fail.put(url)
-        logging.warning(f"{url} failed!")
+    def fail_url(self, item):
+        self.lock.acquire()
+        attempts, _ = self.fail.get(item, (0, 0))
+        attempts += 1
+        next_try = time()+self.backoff*2**(attempts-1)
+        self.fail[item] = (attempts, next_try)
+        self.lock.release()
+        if attempts > self.max_retry:
+            logging.error(f"{item} failed {attempts} times, give up.")
+        else:
+            logging.warning(f"{item} failed! retry #{attempts} at {next_try}")
+        return attempts, next_try
+
+    def retry_failed(self):
+        """把到期的失败任务放回todo
+
+        返回距离下一个待重试任务的秒数，有任务被放回时返回0，没有待重试任务时返回None
+        """
+        self.lock.acquire()
+        now = time()
+        pending = {item: v for item, v in self.fail.items()
+                   if v[0] <= self.max_retry}
+        due = [item for item, (_, next_try) in pending.items()
+               if next_try <= now]
+        self.todo.update(due)
+        self.lock.release()
+        if due:
+            logging.info(f"retry {len(due)} failed urls.")
+            return 0
+        elif pending:
+            return min(next_try for _, next_try in pending.values())-now
+        else:
+            return None
 
     def add_urls(self, urls):
         self.lock.acquire()
-        self.todo = self.todo.union(urls)
-        if None in self.todo:
-            self.todo.remove(None)
+        self.todo = self.todo.union(
+            item for item in urls if item is not None and item[0] not in self.done)
+        self.cond.notify_all()
         self.lock.release()
 
     def empty(self):
@@ -92,16 +194,266 @@ class Urls:
         self.lock.release()
         return flag
 
+    def close(self):
+        pass
+
+
+class PersistentUrls(Urls):
+    """持久化到sqlite的任务队列
+
+    状态变化先缓存在内存中，每积累checkpoint条再批量写入数据库。
+    重启时从数据库恢复todo、done和fail，已完成的页面不会再被爬取。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS "frontier" (
+        "url"	TEXT PRIMARY KEY,
+        "show_name"	TEXT,
+        "state"	TEXT,
+        "attempts"	INTEGER DEFAULT 0,
+        "next_try"	REAL DEFAULT 0
+    );
+    """
+
+    UPSERT_SQL = """
+    INSERT INTO frontier (url,show_name,state,attempts,next_try) VALUES(?,?,?,?,?)
+    ON CONFLICT(url) DO UPDATE SET
+        state=excluded.state,attempts=excluded.attempts,next_try=excluded.next_try
+    """
+
+    def __init__(self, filename, checkpoint=50, **kwargs):
+        super().__init__(**kwargs)
+        self.checkpoint = checkpoint
+        self.pending = []
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute(self.SCHEMA)
+        self.conn.commit()
+        self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def load(self):
+        rows = self.conn.execute(
+            "SELECT url,show_name,state,attempts,next_try FROM frontier")
+        for url, show_name, state, attempts, next_try in rows:
+            if state == "done":
+                self.done.add(url)
+            elif state == "fail":
+                self.fail[(url, show_name)] = (attempts, next_try)
+            else:
+                self.todo.add((url, show_name))
+        self.resumed = bool(self.todo or self.done or self.fail)
+        logging.info(
+            f"frontier loaded, todo={len(self.todo)}, done={len(self.done)}, fail={len(self.fail)}")
+
+    def _log(self, url, show_name, state, attempts=0, next_try=0):
+        """记录一次状态变化，调用时必须持有锁"""
+        self.pending.append((url, show_name, state, attempts, next_try))
+        if len(self.pending) >= self.checkpoint:
+            self._flush()
+
+    def _flush(self):
+        self.conn.executemany(self.UPSERT_SQL, self.pending)
+        self.conn.commit()
+        logging.debug(f"checkpoint {len(self.pending)} url states.")
+        self.pending = []
+
+    def flush(self):
+        self.lock.acquire()
+        self._flush()
+        self.lock.release()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def add_urls(self, urls):
+        self.lock.acquire()
+        for item in urls:
+            if item is None or item[0] in self.done or item in self.todo or item in self.fail:
+                continue
+            self.todo.add(item)
+            self._log(item[0], item[1], "todo")
+        self.cond.notify_all()
+        self.lock.release()
+
+    def done_url(self, item):
+        super().done_url(item)
+        self.lock.acquire()
+        self._log(item[0], item[1], "done")
+        self.lock.release()
+
+    def fail_url(self, item):
+        attempts, next_try = super().fail_url(item)
+        self.lock.acquire()
+        self._log(item[0], item[1], "fail", attempts, next_try)
+        self.lock.release()
+        return attempts, next_try
+
+
+class ResponseCache:
+    """本地磁盘响应缓存
+
+    以url为键保存zlib压缩后的页面，ttl秒内的缓存直接使用，
+    过期后带上ETag/Last-Modified发送条件请求，服务器返回304时继续使用缓存。
+    同时记录每部剧的最后一页页码，在ttl内可以跳过404探测。
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS "responses" (
+        "url"	TEXT PRIMARY KEY,
+        "body"	BLOB,
+        "etag"	TEXT,
+        "last_modified"	TEXT,
+        "fetched_at"	REAL
+    );
+    CREATE TABLE IF NOT EXISTS "last_pages" (
+        "base_url"	TEXT PRIMARY KEY,
+        "page"	INTEGER,
+        "fetched_at"	REAL
+    );
+    """
+
+    def __init__(self, filename, ttl=86400):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    def _is_fresh(self, fetched_at):
+        return time()-fetched_at < self.ttl
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body,etag,last_modified,fetched_at FROM responses WHERE url=?", (url,)).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, fetched_at = row
+        return CachedResponse(zlib.decompress(body), etag, last_modified, self._is_fresh(fetched_at))
+
+    def put(self, url, body, etag=None, last_modified=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (url,body,etag,last_modified,fetched_at) VALUES(?,?,?,?,?)",
+                (url, zlib.compress(body), etag, last_modified, time()))
+            self.conn.commit()
+
+    def touch(self, url):
+        """服务器确认内容没有变化，刷新缓存时间"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE responses SET fetched_at=? WHERE url=?", (time(), url))
+            self.conn.commit()
+
+    def get_last_page(self, base_url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT page,fetched_at FROM last_pages WHERE base_url=?", (base_url,)).fetchone()
+        if row and self._is_fresh(row[1]):
+            return row[0]
+        return None
+
+    def set_last_page(self, base_url, page):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO last_pages (base_url,page,fetched_at) VALUES(?,?,?)",
+                (base_url, page, time()))
+            self.conn.commit()
+
+    @staticmethod
+    def conditional_headers(cached):
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        return headers
+
+    def close(self):
+        self.conn.close()
+
 
 class Download:
+    def __init__(self, cache=None, session=None):
+        self.cache = cache
+        # 限速、重试并复用连接
+        self.session = session or RateLimitedSession()
+
     def download(self, url, encodeing="gbk"):
-        r = requests.get(url)
+        cached = self.cache.get(url) if self.cache else None
+        if cached and cached.fresh:
+            logging.debug(f"{url} hit cache.")
+            return cached.body.decode(encodeing, errors="replace")
+        r = self.session.get(
+            url, headers=ResponseCache.conditional_headers(cached))
         if r.status_code == 404:
             raise PageNotFoundException()
+        if r.status_code == 304 and cached:
+            logging.debug(f"{url} not modified.")
+            self.cache.touch(url)
+            return cached.body.decode(encodeing, errors="replace")
+        if r.status_code != 200:
+            # 重试用完之后仍然是5xx等错误，错误页面不能当作剧情解析
+            raise requests.exceptions.HTTPError(
+                f"{url} returned {r.status_code}", response=r)
+        if self.cache:
+            self.cache.put(url, r.content, r.headers.get("ETag"),
+                           r.headers.get("Last-Modified"))
         r.encoding = encodeing
         return r.text
 
 
+class AsyncDownload:
+    """基于aiohttp的异步下载器
+
+    复用同一个ClientSession的连接池，concurrency限制全局并发连接数，
+    per_host限制对同一主机的并发连接数，避免对站点造成过大压力。
+    """
+
+    def __init__(self, concurrency=32, per_host=8, cache=None, limiter=None, policy=None):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.cache = cache
+        self.limiter = limiter or RateLimiter()
+        self.policy = policy or RetryPolicy()
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency, limit_per_host=self.per_host)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def download(self, url, encodeing="gbk"):
+        cached = self.cache.get(url) if self.cache else None
+        if cached and cached.fresh:
+            logging.debug(f"{url} hit cache.")
+            return cached.body.decode(encodeing, errors="replace")
+        r = await async_get(self.session, url, self.limiter, self.policy,
+                            headers=ResponseCache.conditional_headers(cached))
+        if r.status == 404:
+            raise PageNotFoundException()
+        if r.status == 304 and cached:
+            logging.debug(f"{url} not modified.")
+            self.cache.touch(url)
+            return cached.body.decode(encodeing, errors="replace")
+        if r.status != 200:
+            raise aiohttp.ClientError(f"{url} returned {r.status}")
+        if self.cache:
+            self.cache.put(url, r.body, r.headers.get("ETag"),
+                           r.headers.get("Last-Modified"))
+        return r.body.decode(encodeing, errors="replace")
+
+
 class PlotParser:
     @staticmethod
     def predicate(episode, title_matched=True):
@@ -113,8 +465,6 @@ class PlotParser:
         @debug_tool
         def f(r):
             nonlocal title_matched
-            logging.debug(f"episode={episode}, title_matched={title_matched}")
-            content = get_full_content(r)
             if PlotParser.is_episode(r, episode):
                 return False
             elif not title_matched and PlotParser.is_title(r):
@@ -133,38 +483,30 @@ class PlotParser:
     @staticmethod
     @debug_tool
     def is_episode(r, episode=""):
-        content = get_full_content(r)
-        match = EPISODE_RE.match(content)
-        if match and match.group(1) and match.group(1) != episode and len(content) < TITLE_LENGTH:
-            return True
-        else:
-            return False
+        line = as_line(r)
+        return bool(line.episode) and line.episode != episode
 
     @staticmethod
     @debug_tool
     def is_title(r, episode="", skip_episode=False):
-        flag = (bool(r.tag == "strong") or len(
-            get_full_content(r)) < TITLE_LENGTH) and (skip_episode or not PlotParser.is_episode(r, episode))
-        logging.debug(f"len={len(get_full_content(r))}")
-        logging.debug(f"{get_full_content(r)} is {flag}")
-
-        return flag
+        line = as_line(r)
+        return (line.tag == "strong" or len(line.text) < TITLE_LENGTH) and (
+            skip_episode or not PlotParser.is_episode(line, episode))
 
     @staticmethod
     def skip_empty_lines(it):
-        return takewhile(lambda r: bool(get_full_content(r)), it)
+        return takewhile(lambda r: bool(as_line(r).text), it)
 
     def parse_html(self):
         logging.info(f"parsing {self.url}...")
         # self.put_urls()
         yield from self.get_plots()
-        self.urls.done_url(self.url)
         logging.info(f"{self.url}已经完成")
 
     def get_plots(self):
-        results = self.html.xpath(
+        results = compile_lines(self.html.xpath(
             "//div[@id='AAA']/p | //h4"
-        )
+        ))
         try:
             while True:
                 results, plot = self.get_plot(results)
@@ -185,11 +527,11 @@ class PlotParser:
 
         # 尝试解决空格行的问题
         #results = PlotParser.skip_empty_lines(results)
-        episode_dom = next(results)
-        logging.debug(f"episode_dom={episode_dom.text}")
+        episode_line = next(results)
+        logging.debug(f"episode_line={episode_line.text}")
 
         # 匹配集数
-        episode_title = get_full_content(episode_dom)
+        episode_title = episode_line.text
         match = EPISODE_RE.search(episode_title)
         if match:
             episode = EXTRACT_EPISODE_RE.search(episode_title).group(1)
@@ -212,10 +554,10 @@ class PlotParser:
                 predicate = self.predicate(episode, title_matched=True)
         else:
             # 否则需要匹配标题(下一行)
-            title_dom = next(results)
-            title = get_full_content(title_dom)
+            title_line = next(results)
+            title = title_line.text
             # 尝试识别是否为标题，如果该行不加粗且字数超过30，认为该行属于正文
-            if not PlotParser.is_title(title_dom, skip_episode=True):
+            if not PlotParser.is_title(title_line, skip_episode=True):
                 title, detail = "", title
                 logging.warning(f"{self.show_name}-{episode} missing title!")
             else:
@@ -223,9 +565,9 @@ class PlotParser:
 
         rest_it = results
         for line in results:
-            logging.debug(f"line={get_full_content(line)}")
+            logging.debug(f"line={line.text}")
             if predicate(line):
-                detail += get_full_content(line)
+                detail += line.text
             else:
                 rest_it = chain([line, ], results)
                 break
@@ -235,17 +577,25 @@ class PlotParser:
         intros = self.html.xpath('//ul[contains(@class,"c2")]//a')
         for intro in intros:
             url = intro.get("href")
-            text = get_full_content(intro)
             if PlotParser.is_episode(intro) and not self.urls.is_done(url):
                 self.urls.add_urls([(url, self.show_name), ])
                 logging.debug(f"put {url} into urls")
         return intros
 
 
+def page_range(cache, base_url, limit):
+    """剧集分页的页码范围，缓存中有最后一页时不再需要探测404"""
+    last_page = cache.get_last_page(base_url) if cache else None
+    if last_page is not None:
+        return range(2, last_page+1)
+    return range(2, limit)
+
+
 class PlotScheduler:
-    def __init__(self, urls,  limit=100):
+    def __init__(self, urls,  limit=100, cache=None, session=None):
         self.limit = limit
-        self.download = Download()
+        self.cache = cache
+        self.download = Download(cache, session)
         self.urls = urls
 
     def get_plots(self, base_url, show_name):
@@ -257,19 +607,101 @@ class PlotScheduler:
         )
         yield from parser.parse_html()
         try:
-            for i in range(2, self.limit):
+            for i in page_range(self.cache, base_url, self.limit):
                 url = f"{base_url}_{i}.html"
                 html = self.download.download(url)
                 parser = PlotParser(show_name, html, url, self.urls)
                 yield from parser.get_plots()
         except PageNotFoundException:
             logging.info(f"{show_name}-{base_url} is done.")
+            if self.cache:
+                self.cache.set_last_page(base_url, i-1)
 
     def run(self):
-        while not self.urls.empty():
-            base_url, show_name = self.urls.get_url()
+        while True:
+            item = self.urls.wait_url()
+            if item is None:
+                break
+            base_url, show_name = item
+            base_url = base_url.rstrip(".html")
+            try:
+                yield from self.get_plots(base_url, show_name)
+            except PageNotFoundException:
+                # 剧集的第一页不存在，重试也没有意义
+                logging.warning(f"{base_url}.html not found, skip {show_name}.")
+                self.urls.done_url(item)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"{base_url} download failed: {e}")
+                self.urls.fail_url(item)
+            else:
+                self.urls.done_url(item)
+
+
+class AsyncPlotScheduler:
+    """PlotScheduler的异步版本
+
+    同一部剧的分页每次并发下载window页，遇到404即停止。
+    """
+
+    def __init__(self, urls, download, limit=100, window=4, poll=0.05):
+        self.limit = limit
+        self.window = window
+        self.poll = poll
+        self.download = download
+        self.urls = urls
+
+    async def get_plots(self, base_url, show_name):
+        url = f"{base_url}.html"
+        parser = PlotParser(
+            show_name, await self.download.download(url), url, self.urls)
+        plots = list(parser.parse_html())
+        cache = getattr(self.download, "cache", None)
+        all_pages = page_range(cache, base_url, self.limit)
+        for start in range(0, len(all_pages), self.window):
+            pages = all_pages[start:start+self.window]
+            page_urls = [f"{base_url}_{i}.html" for i in pages]
+            htmls = await asyncio.gather(
+                *map(self.download.download, page_urls),
+                return_exceptions=True
+            )
+            for i, url, html in zip(pages, page_urls, htmls):
+                if isinstance(html, PageNotFoundException):
+                    logging.info(f"{show_name}-{base_url} is done.")
+                    if cache:
+                        cache.set_last_page(base_url, i-1)
+                    return plots
+                elif isinstance(html, Exception):
+                    raise html
+                parser = PlotParser(show_name, html, url, self.urls)
+                plots.extend(parser.get_plots())
+        return plots
+
+    async def run(self, callback):
+        """不断从任务队列中取出剧集，每完成一部剧就把结果交给callback
+
+        callback可能阻塞（例如写入队列已满），在线程中调用，不会阻塞事件循环中的其他下载。
+        """
+        while True:
+            if self.urls.empty():
+                if not self.urls.producing:
+                    break
+                # 索引还在发现新剧集，稍后再取
+                await asyncio.sleep(self.poll)
+                continue
+            item = self.urls.get_url()
+            base_url, show_name = item
             base_url = base_url.rstrip(".html")
-            yield from self.get_plots(base_url, show_name)
+            try:
+                plots = await self.get_plots(base_url, show_name)
+            except PageNotFoundException:
+                logging.warning(f"{base_url}.html not found, skip {show_name}.")
+                self.urls.done_url(item)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"{base_url} download failed: {e}")
+                self.urls.fail_url(item)
+            else:
+                await asyncio.to_thread(callback, plots)
+                self.urls.done_url(item)
 
 
 class MainPageParser:
@@ -305,10 +737,10 @@ class MainPageParser:
 
 
 class MainPageScheduler:
-    def __init__(self, base_url, limit=100, urls=None):
+    def __init__(self, base_url, limit=100, urls=None, cache=None, session=None):
         self.base_url = base_url.rstrip(".html")
         self.limit = limit
-        self.download = Download()
+        self.download = Download(cache, session)
         self.urls = urls
 
     def get_shows(self):
@@ -320,15 +752,38 @@ class MainPageScheduler:
         try:
             for i in range(1, self.limit):
                 url = f"{self.base_url}_{i}.html"
-                self.urls.add_urls(
-                    MainPageParser(self.download.download(
-                        url), url).get_shows()
-                )
+                try:
+                    html = self.download.download(url)
+                except requests.exceptions.RequestException as e:
+                    # 跳过出错的索引页，下次运行时会重新爬取索引
+                    logging.error(f"{url} download failed: {e}")
+                    continue
+                self.urls.add_urls(MainPageParser(html, url).get_shows())
+        except PageNotFoundException:
+            logging.info(f"crawler on {self.base_url} is done.")
+
+    async def async_get_shows(self, download):
+        """get_shows的异步版本，每解析完一页索引就把剧集放入任务队列"""
+        try:
+            for i in range(1, self.limit):
+                url = f"{self.base_url}_{i}.html"
+                try:
+                    html = await download.download(url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.error(f"{url} download failed: {e}")
+                    continue
+                self.urls.add_urls(MainPageParser(html, url).get_shows())
         except PageNotFoundException:
             logging.info(f"crawler on {self.base_url} is done.")
 
 
 class Output:
+    """剧情数据库
+
+    plots以(show_name, episode, url)为主键，重复爬取同一页面时按主键更新。
+    无法识别集数的剧情episode为"0"，url作为主键的一部分，不同页面上的这些剧情不会互相覆盖。
+    content_hash是标题、正文和url的摘要，内容没有变化的剧情不会被重写。
+    """
 
     SCHEMA = """
     CREATE TABLE IF NOT EXISTS "plots" (
@@ -337,12 +792,42 @@ class Output:
         "title"	TEXT,
         "detail"	TEXT,
         "edit_time"	TEXT,
-        "url" TEXT
+        "url" TEXT,
+        "content_hash"	TEXT,
+        PRIMARY KEY("show_name","episode","url")
     );
+    CREATE INDEX IF NOT EXISTS "plots_url" ON "plots" ("url");
+    """
+
+    # 旧版本的表没有主键，并且edit_time和url两列的值写反了
+    MIGRATE_SQL = """
+    ALTER TABLE plots RENAME TO plots_old;
+    {schema}
+    INSERT OR REPLACE INTO plots (show_name,episode,title,detail,edit_time,url)
+    SELECT show_name,episode,title,detail,
+        CASE WHEN edit_time LIKE 'http%' THEN url ELSE edit_time END,
+        CASE WHEN edit_time LIKE 'http%' THEN edit_time ELSE url END
+    FROM plots_old;
+    DROP TABLE plots_old;
     """
 
-    INIT_SQL = """
-    DELETE FROM plots WHERE datetime("now")>plots.edit_time;
+    # 主键为(show_name, episode)的表，保留content_hash
+    MIGRATE_KEY_SQL = """
+    DROP INDEX IF EXISTS plots_url;
+    ALTER TABLE plots RENAME TO plots_old;
+    {schema}
+    INSERT INTO plots (show_name,episode,title,detail,edit_time,url,content_hash)
+    SELECT show_name,episode,title,detail,edit_time,url,content_hash FROM plots_old;
+    DROP TABLE plots_old;
+    """
+
+    UPSERT_SQL = """
+    INSERT INTO plots (show_name,episode,title,detail,url,content_hash,edit_time)
+    VALUES(?,?,?,?,?,?,datetime("now"))
+    ON CONFLICT(show_name,episode,url) DO UPDATE SET
+        title=excluded.title,detail=excluded.detail,
+        content_hash=excluded.content_hash,edit_time=excluded.edit_time
+    WHERE plots.content_hash IS NOT excluded.content_hash
     """
 
     def __init__(self):
@@ -353,8 +838,20 @@ class Output:
 
     def open_db(self, filename):
         self.conn = sqlite3.connect(filename)
-        self.conn.execute(self.SCHEMA)
-        self.conn.execute(self.INIT_SQL)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1]: row[5] for row in self.conn.execute(
+            "PRAGMA table_info(plots)")}
+        if columns and "content_hash" not in columns:
+            logging.info("migrating plots table...")
+            self.conn.executescript(
+                self.MIGRATE_SQL.format(schema=self.SCHEMA))
+        elif columns and not columns["url"]:
+            logging.info("adding url to the primary key of plots table...")
+            self.conn.executescript(
+                self.MIGRATE_KEY_SQL.format(schema=self.SCHEMA))
+        else:
+            self.conn.executescript(self.SCHEMA)
         self.conn.commit()
         return self
 
@@ -364,40 +861,218 @@ class Output:
         if exc_type:
             raise
 
+    @staticmethod
+    def content_hash(plot):
+        content = "\x00".join((plot.title, plot.detail, plot.url))
+        return hashlib.sha1(content.encode("utf8")).hexdigest()
+
     def store_to_db(self, plots):
-        sql = """
-        INSERT INTO plots (show_name,episode,title,detail,edit_time,url) VALUES(?,?,?,?,?,datetime("now"))
-        """
-        self.conn.executemany(sql, plots)
-        self.conn.commit()
+        """在一个事务中批量写入，返回实际新增或更新的行数"""
+        rows = [(*plot, self.content_hash(plot)) for plot in plots]
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany(self.UPSERT_SQL, rows)
+        return self.conn.total_changes-before
+
+    def get_plots(self, show_name):
+        """按剧名查询，使用主键索引"""
+        rows = self.conn.execute(
+            "SELECT show_name,episode,title,detail,url FROM plots WHERE show_name=?", (show_name,))
+        return [Plot_para(*row) for row in rows]
+
+
+class PlotWriter(Thread):
+    """单独的数据库写入线程
+
+    爬虫线程通过put把Plot_para放入有界队列，写入线程每凑满batch_size条
+    就用一次executemany事务写入数据库。队列满时put会阻塞，从而限制内存占用。
+    sqlite连接只能在创建它的线程中使用，所以数据库在run中打开。
+    """
+
+    STOP = object()
+
+    def __init__(self, output, filename, batch_size=100, queue_size=1000):
+        super().__init__(name="PlotWriter")
+        self.output = output
+        self.filename = filename
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.count = 0
+        self.changed = 0
+        self.error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.queue.put(self.STOP)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def put(self, plot):
+        if self.error:
+            raise self.error
+        self.queue.put(plot)
+
+    def put_many(self, plots):
+        for plot in plots:
+            self.put(plot)
+
+    def run(self):
+        try:
+            with self.output.open_db(self.filename) as output:
+                batch = []
+                while True:
+                    plot = self.queue.get()
+                    if plot is self.STOP:
+                        break
+                    batch.append(plot)
+                    if len(batch) >= self.batch_size:
+                        self.flush(output, batch)
+                        batch = []
+                self.flush(output, batch)
+        except Exception as e:
+            logging.error(f"writer failed: {e}")
+            self.error = e
+            # 继续消费队列，避免生产者永久阻塞
+            while self.queue.get() is not self.STOP:
+                pass
+
+    def flush(self, output, batch):
+        if batch:
+            self.changed += output.store_to_db(batch)
+            self.count += len(batch)
+            logging.info(f"已处理{self.count}条剧情，其中{self.changed}条有变化")
 
 
 class Scheduler:
-    def __init__(self):
-        self.urls = Urls()
+    def __init__(self, engine="thread", concurrency=32, per_host=8,
+                 batch_size=100, queue_size=1000, frontier=None,
+                 cache=None, cache_ttl=86400, index_url=INDEX_URL,
+                 interactive=False, rate=20):
+        self.urls = PersistentUrls(frontier) if frontier else Urls()
+        self.cache = ResponseCache(cache, cache_ttl) if cache else None
+        # 索引和剧情页面在同一个站点，共享一个限速器
+        self.limiter = RateLimiter(rate)
+        session = RateLimitedSession(self.limiter)
         self.mainPageScheduler = MainPageScheduler(
-            "http://www.bjxyxd.com/3/list_3.html", limit=58, urls=self.urls)
-        self.plotScheduler = PlotScheduler(self.urls)
+            index_url, limit=58, urls=self.urls, cache=self.cache, session=session)
+        self.plotScheduler = PlotScheduler(
+            self.urls, cache=self.cache, session=session)
         self.output = Output()
+        self.engine = engine
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.interactive = interactive
 
     def crawler(self):
-        self.mainPageScheduler.get_shows()
-        input(
-            f"韩剧索引已完成，共找到剧集链接{len(self.mainPageScheduler.urls.todo)}，任意键继续")
-        with self.output.open_db("tv.db") as output:
-            with futures.ThreadPoolExecutor(8) as executor:
-                todo_list = []
-                for i in range(8):
-                    future = executor.submit(self.plotScheduler.run)
-                    todo_list.append(future)
-                results = futures.as_completed(todo_list)
-                # 把所得结果拍扁以后传给数据库
-                output.store_to_db(chain.from_iterable(
-                    map(lambda i: i.result(), results)))
-
+        # 断点续爬时也重新爬取索引，上次中断前没有发现的剧集才不会遗漏，
+        # add_urls会跳过已经完成或已知的剧集。
+        # 非交互模式下索引和剧情同时爬取，交互模式下先完成索引再确认
+        if self.urls.resumed:
+            logging.info("从上次的断点继续爬取")
+        discover = not self.interactive
+        try:
+            if self.interactive:
+                self.mainPageScheduler.get_shows()
+                input(
+                    f"韩剧索引已完成，共找到剧集链接{len(self.mainPageScheduler.urls.todo)}，任意键继续")
+            writer = PlotWriter(self.output, "tv.db",
+                                self.batch_size, self.queue_size)
+            with writer:
+                while True:
+                    if self.engine == "async":
+                        asyncio.run(self.async_crawler(writer, discover))
+                    else:
+                        self.thread_crawler(writer, discover)
+                    discover = False
+                    # 按退避时间重试失败的任务，直到没有可重试的任务
+                    wait = self.urls.retry_failed()
+                    if wait is None:
+                        break
+                    sleep(max(wait, 0))
+        finally:
+            # 出错时也要保存还没有写入的任务状态
+            self.urls.close()
+            if self.cache:
+                self.cache.close()
+
+    def produce(self, writer):
+        """在爬虫线程中消费生成器，边解析边把结果交给写入线程"""
+        writer.put_many(self.plotScheduler.run())
+
+    def discover(self):
+        """在单独的线程中爬取索引，爬虫线程同时开始处理已发现的剧集"""
+        try:
+            self.mainPageScheduler.get_shows()
+        finally:
+            self.urls.stop_producer()
+
+    def thread_crawler(self, writer, discover=False):
+        with futures.ThreadPoolExecutor(9) as executor:
+            todo_list = []
+            if discover:
+                # 必须在爬虫线程启动前登记生产者，否则它们会因为队列为空直接退出
+                self.urls.start_producer()
+                todo_list.append(executor.submit(self.discover))
+            for i in range(8):
+                future = executor.submit(self.produce, writer)
+                todo_list.append(future)
+            for future in futures.as_completed(todo_list):
+                future.result()
+
+    async def async_discover(self, download):
+        try:
+            await self.mainPageScheduler.async_get_shows(download)
+        finally:
+            self.urls.stop_producer()
+
+    async def async_crawler(self, writer, discover=False):
+        async with AsyncDownload(self.concurrency, self.per_host, self.cache, self.limiter) as download:
+            scheduler = AsyncPlotScheduler(self.urls, download)
+            tasks = []
+            if discover:
+                self.urls.start_producer()
+                tasks.append(self.async_discover(download))
+            # 每个worker负责一部剧，所有worker共享同一个连接池
+            tasks.extend(scheduler.run(writer.put_many)
+                         for _ in range(self.concurrency))
+            await asyncio.gather(*tasks)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--engine", help="爬虫引擎，thread为多线程，async为异步IO",
+                    default="thread", choices=("thread", "async"))
+parser.add_argument("-c", "--concurrency", help="异步模式下的全局并发连接数",
+                    type=int, default=32)
+parser.add_argument("--per-host", help="异步模式下对同一主机的并发连接数",
+                    type=int, default=8)
+parser.add_argument("-b", "--batch-size", help="每个数据库事务写入的剧情条数",
+                    type=int, default=100)
+parser.add_argument("-q", "--queue-size", help="待写入剧情队列的最大长度",
+                    type=int, default=1000)
+parser.add_argument("-f", "--frontier", help="持久化任务队列的数据库文件，指定后支持断点续爬",
+                    default=None)
+parser.add_argument("--cache", help="本地响应缓存的数据库文件，指定后启用条件请求缓存",
+                    default=None)
+parser.add_argument("--cache-ttl", help="缓存有效期（秒），过期后向服务器重新验证",
+                    type=float, default=86400)
+parser.add_argument("--index-url", help="剧集索引的第一页，可指向本地替身服务器",
+                    default=INDEX_URL)
+parser.add_argument("-r", "--rate", help="每秒请求数的初始值，之后根据服务器响应自动调整",
+                    type=float, default=20)
+parser.add_argument("-i", "--interactive", help="先完成全部索引，确认后再爬取剧情",
+                    action="store_true")
 
 logging.basicConfig(level=logging.INFO, filename="log.log")
 if __name__ == "__main__":
-
-    scheduler = Scheduler()
+    arg = parser.parse_args()
+    scheduler = Scheduler(arg.engine, arg.concurrency, arg.per_host,
+                          arg.batch_size, arg.queue_size, arg.frontier,
+                          arg.cache, arg.cache_ttl, arg.index_url,
+                          arg.interactive, arg.rate)
     scheduler.crawler()
@@ -1,11 +1,17 @@
+import gzip
+import os
+import time
+import zlib
 import requests
 from datetime import date, timedelta
 from concurrent import futures
 import argparse
 from pathlib import Path
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession
 
 URL = "http://files.tmdb.org/p/exports/tv_series_ids_%m_%d_%Y.json.gz"
-FILENAME = "data/tv_series_ids_%m_%d_%Y.json.gz"
+FILENAME = "tv_series_ids_%m_%d_%Y.json.gz"
+CHUNK_SIZE = 64*1024
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-p", "--path", help="下载数据的目录", default="data", type=Path)
@@ -14,34 +20,74 @@ parser.add_argument("-s", "--start", help="日报的开始日期", default=str(
     date.today()), type=date.fromisoformat)
 # 根据网站客服提供的技术信息，daily report只能访问90天内的导出
 parser.add_argument("-n", help="要下载的天数", default=1, type=int)
+parser.add_argument("--url", help="导出文件的URL模板，可指向本地替身服务器", default=URL)
+parser.add_argument("--retry", help="连接失败重传数", type=int, default=3)
 
 
-def download(cur_date: date)->str:
+def is_valid_gzip(fpath: Path)->bool:
+    """完整解压一遍，检查gzip流没有被截断或损坏"""
+    try:
+        with gzip.open(fpath, "rb") as f:
+            while f.read(CHUNK_SIZE):
+                pass
+    except (OSError, EOFError, zlib.error):
+        return False
+    return True
+
+
+def download(cur_date: date, path=Path("data"), url=URL, session=requests)->str:
     """下载日期为cur_date的daily export
 
+    分块写入临时文件，完整且通过校验后再原子地重命名，内存占用与文件大小无关。
+    已经存在且完整的文件会被跳过，上次中断留下的临时文件用Range请求续传。
     返回结果字符串。
     """
 
-    target_url = cur_date.strftime(URL)
-    print(f"下载{target_url}...")
-    r = requests.get(target_url)
-    content = r.content
-    if len(content) < 1000 and b"Access Denied" in content:
-        print(f"{target_url}无法访问!")
-        return f"{target_url}无法访问!"
-    else:
-        target_filename = cur_date.strftime(FILENAME)
-        with open(target_filename, "wb") as f:
-            f.write(content)
-        print(f"成功保存至{target_filename}")
-        return f"成功保存至{target_filename}"
+    target_url = cur_date.strftime(url)
+    target_filename = path/cur_date.strftime(FILENAME)
+    if target_filename.exists() and is_valid_gzip(target_filename):
+        return f"{target_filename}已经存在"
+    part_filename = target_filename.with_name(target_filename.name+".part")
+    offset = part_filename.stat().st_size if part_filename.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    print(f"下载{target_url}..." if not offset else f"从{offset}字节处继续下载{target_url}...")
+    start_time = time.perf_counter()
+    received = 0
+    with session.get(target_url, headers=headers, stream=True) as r:
+        if r.status_code == 416:
+            # 临时文件已经完整，只是上次没来得及重命名
+            pass
+        elif r.status_code not in (200, 206):
+            print(f"{target_url}无法访问!")
+            return f"{target_url}无法访问!"
+        else:
+            # 服务器不支持Range时返回200，从头下载
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part_filename, mode) as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+    elapsed = time.perf_counter()-start_time
+    if not is_valid_gzip(part_filename):
+        part_filename.unlink()
+        print(f"{target_url}下载的文件不完整!")
+        return f"{target_url}下载的文件不完整!"
+    os.replace(part_filename, target_filename)
+    print(f"成功保存至{target_filename}，{received/max(elapsed, 1e-9)/1024:.1f}KB/s")
+    return f"成功保存至{target_filename}"
 
 
 if __name__ == "__main__":
     arg = parser.parse_args()
+    arg.path.mkdir(parents=True, exist_ok=True)
     START_DATE = arg.start
+    session = RateLimitedSession(RateLimiter(), RetryPolicy(arg.retry))
     todo = (START_DATE+n*timedelta(days=1) for n in range(arg.n))
+    start_time = time.perf_counter()
     with futures.ThreadPoolExecutor(arg.thread) as exeutor:
-        results = exeutor.map(download, todo)
+        results = exeutor.map(lambda d: download(d, arg.path, arg.url, session), todo)
     for result in results:
         print(result)
+    elapsed = time.perf_counter()-start_time
+    total = sum(f.stat().st_size for f in arg.path.glob("tv_series_ids_*.json.gz"))
+    print(f"用时{elapsed:.1f}s，目录中的导出共{total/1024/1024:.1f}MB")
@@ -0,0 +1,114 @@
+import logging
+import time
+from datetime import date
+
+from read_daily_exports import init_db
+
+
+def date_key(d: date)->str:
+    """数据库中的日期格式，月和日没有补零"""
+    return f"{d.year}-{d.month}-{d.day}"
+
+
+class PopularityRanking:
+    """基于每日排名表daily_rank的top-N查询
+
+    每天只在第一次查询时，借助(create_at, popularity)索引取出前depth名写入daily_rank，
+    之后任意日期范围的top-N和排名变化都只需要一次查询，排名在depth之外的条目视为没有上榜。
+    趋势不受depth限制，借助(id, create_at)索引直接从popularity表读取。
+    """
+
+    def __init__(self, conn, depth=1000):
+        self.conn = conn
+        self.depth = depth
+        init_db(conn)
+
+    def ensure(self, dates):
+        """为还没有排名的日期生成排名，返回新生成的天数"""
+        keys = [date_key(d) for d in dates]
+        ranked = self._ranked_dates(keys)
+        built = 0
+        with self.conn:
+            for key in keys:
+                if key in ranked:
+                    continue
+                start_time = time.perf_counter()
+                rows = self.conn.execute(
+                    "SELECT id,popularity FROM popularity WHERE create_at=? ORDER BY popularity DESC LIMIT ?",
+                    (key, self.depth)).fetchall()
+                self.conn.executemany(
+                    "INSERT INTO daily_rank (create_at,rank,id,popularity) VALUES(?,?,?,?)",
+                    ((key, rank, id, popularity) for rank, (id, popularity) in enumerate(rows, 1)))
+                if rows:
+                    built += 1
+                    logging.debug(
+                        f"ranked {key} in {time.perf_counter()-start_time:.4f}s")
+                else:
+                    logging.warning(f"no popularity data at {key}")
+        return built
+
+    def _ranked_dates(self, keys):
+        marks = ",".join("?"*len(keys))
+        return {row[0] for row in self.conn.execute(
+            f"SELECT DISTINCT create_at FROM daily_rank WHERE create_at IN ({marks}) AND rank=1", keys)}
+
+    def _select(self, dates, where, params):
+        keys = [date_key(d) for d in dates]
+        marks = ",".join("?"*len(keys))
+        return self.conn.execute(
+            f"SELECT create_at,rank,id,popularity FROM daily_rank WHERE create_at IN ({marks}) AND {where} "
+            "ORDER BY create_at,rank", (*keys, *params)).fetchall()
+
+    def top_n(self, dates, n=10):
+        """返回{日期: [(id, popularity), ...]}，每天按欢迎度降序"""
+        dates = list(dates)
+        self.ensure(dates)
+        ans = {d: [] for d in dates}
+        by_key = {date_key(d): d for d in dates}
+        for key, rank, id, popularity in self._select(dates, "rank<=?", (n,)):
+            ans[by_key[key]].append((id, popularity))
+        return ans
+
+    def rank_changes(self, dates, n=10):
+        """返回{日期: [(id, 排名, 前一天的排名), ...]}
+
+        前一天没有上榜时排名为None，dates的第一天与它的前一天比较。
+        """
+        dates = list(dates)
+        if not dates:
+            return {}
+        previous = dates[0].fromordinal(dates[0].toordinal()-1)
+        top = self.top_n(dates, n)
+        ids = {id for items in top.values() for id, _ in items}
+        ranks = self._ranks(ids, [previous, *dates])
+        ans = {}
+        for prev_day, d in zip([previous, *dates], dates):
+            ans[d] = [(id, rank, ranks.get((id, prev_day)))
+                      for rank, (id, _) in enumerate(top[d], 1)]
+        return ans
+
+    def _ranks(self, ids, dates):
+        """返回{(id, 日期): 排名}"""
+        self.ensure(dates)
+        by_key = {date_key(d): d for d in dates}
+        marks = ",".join("?"*len(ids))
+        return {(id, by_key[key]): rank for key, rank, id, _ in self._select(
+            dates, f"id IN ({marks})", tuple(ids))}
+
+    def trend(self, ids, dates):
+        """返回{id: [每天的popularity]}，当天的导出中没有该条目时为None"""
+        dates = list(dates)
+        keys = [date_key(d) for d in dates]
+        by_key = {key: i for i, key in enumerate(keys)}
+        ids = list(ids)
+        ans = {id: [None]*len(keys) for id in ids}
+        date_marks = ",".join("?"*len(keys))
+        # 分批查询，避免超过sqlite的参数个数限制
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start+500]
+            id_marks = ",".join("?"*len(chunk))
+            for id, key, popularity in self.conn.execute(
+                    f"SELECT id,create_at,popularity FROM popularity WHERE id IN ({id_marks}) "
+                    f"AND create_at IN ({date_marks})", (*chunk, *keys)):
+                ans[id][by_key[key]] = popularity
+        return ans
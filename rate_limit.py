@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import random
+import time
+from collections import namedtuple
+from threading import Lock
+
+import aiohttp
+import requests
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+AsyncResponse = namedtuple("AsyncResponse", ("status", "headers", "body"))
+
+
+class RateLimiter:
+    """令牌桶限速器
+
+    rate是每秒发放的令牌数，burst是桶的容量。
+    每次成功的请求让速率加法增长，收到429或5xx时速率乘法下降（AIMD），
+    这样速率会稳定在服务器允许的上限附近。
+    并发请求在一次过载中会同时收到多个429，降速之前发出的请求的失败不再重复降速。
+    """
+
+    def __init__(self, rate=10, burst=None, min_rate=0.5, max_rate=None,
+                 increase=0.5, decrease=0.5):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate*4
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        # 上次降速的时间
+        self.decreased_at = float("-inf")
+        self.lock = Lock()
+
+    def _reserve(self):
+        """预订一个令牌，返回需要等待的秒数，调用时必须持有锁"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now-self.updated)*self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens/self.rate if self.tokens < 0 else 0
+        return max(wait, self.paused_until-now)
+
+    def acquire(self):
+        with self.lock:
+            wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self):
+        with self.lock:
+            wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def feedback(self, status, retry_after=None, sent_at=None):
+        """根据响应状态码调整速率
+
+        sent_at是发出请求时的time.monotonic()，在上次降速之前发出的请求属于同一次过载，
+        不再降速。没有sent_at时，降速之后的1/rate秒内不再降速。
+        """
+        with self.lock:
+            if status in RETRY_STATUS:
+                now = time.monotonic()
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now+retry_after)
+                if sent_at is not None:
+                    same_burst = sent_at <= self.decreased_at
+                else:
+                    same_burst = now < self.decreased_at+1/self.rate
+                if same_burst:
+                    return
+                self.rate = max(self.min_rate, self.rate*self.decrease)
+                self.decreased_at = now
+                logging.warning(
+                    f"got {status}, rate limit decreased to {self.rate:.2f}/s")
+            elif status < 400:
+                # 每秒大约增加increase
+                self.rate = min(self.max_rate, self.rate +
+                                self.increase/self.rate)
+
+
+class RetryPolicy:
+    """带随机抖动的指数退避重试策略"""
+
+    def __init__(self, retries=3, base=0.5, cap=30, statuses=RETRY_STATUS):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.statuses = statuses
+
+    def delay(self, attempt):
+        # full jitter，避免多个线程同时重试
+        return random.uniform(0, min(self.cap, self.base*2**attempt))
+
+    def should_retry(self, attempt, status=None):
+        return attempt < self.retries and (status is None or status in self.statuses)
+
+
+def parse_retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedSession(requests.Session):
+    """经过限速和重试的requests.Session
+
+    可以直接替换原来的requests.get或Session，同时复用连接。
+    """
+
+    def __init__(self, limiter=None, policy=None, headers=None):
+        super().__init__()
+        self.limiter = limiter or RateLimiter()
+        self.policy = policy or RetryPolicy()
+        if headers:
+            self.headers.update(headers)
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            sent_at = time.monotonic()
+            try:
+                r = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.limiter.feedback(503, sent_at=sent_at)
+                if not self.policy.should_retry(attempt):
+                    raise
+                logging.warning(f"{url} failed: {e}, retrying...")
+            else:
+                self.limiter.feedback(
+                    r.status_code, parse_retry_after(r.headers), sent_at)
+                if not self.policy.should_retry(attempt, r.status_code):
+                    return r
+                logging.warning(f"{url} returned {r.status_code}, retrying...")
+            time.sleep(self.policy.delay(attempt))
+            attempt += 1
+
+
+async def async_get(session, url, limiter, policy, **kwargs):
+    """RateLimitedSession.request的aiohttp版本
+
+    返回已经读取完响应体的AsyncResponse。
+    """
+    attempt = 0
+    while True:
+        await limiter.async_acquire()
+        sent_at = time.monotonic()
+        try:
+            async with session.get(url, **kwargs) as r:
+                limiter.feedback(r.status, parse_retry_after(r.headers), sent_at)
+                if not policy.should_retry(attempt, r.status):
+                    return AsyncResponse(r.status, r.headers, await r.read())
+                logging.warning(f"{url} returned {r.status}, retrying...")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            limiter.feedback(503, sent_at=sent_at)
+            if not policy.should_retry(attempt):
+                raise
+            logging.warning(f"{url} failed: {e}, retrying...")
+        await asyncio.sleep(policy.delay(attempt))
+        attempt += 1
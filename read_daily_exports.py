@@ -3,41 +3,196 @@ from pathlib import Path
 import json
 import sqlite3
 import logging
+import os
 import re
 import argparse
+import time
+from concurrent import futures
+from itertools import islice
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 logging.basicConfig(level=logging.INFO)
 FILENAME_RE = re.compile(r"tv_series_ids_(\d{2})_(\d{2})_(\d{4})\.json")
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS "popularity" (
+    "id"	INTEGER,
+    "original_name"	TEXT,
+    "popularity"	REAL,
+    "create_at"	TEXT
+);
+CREATE INDEX IF NOT EXISTS "popularity_date" ON "popularity" ("create_at", "popularity");
+-- popularity_query.py按id查询欢迎度趋势
+CREATE INDEX IF NOT EXISTS "popularity_id" ON "popularity" ("id", "create_at");
+-- 每天欢迎度最高的若干条目及其排名，由popularity_query.py按需生成
+CREATE TABLE IF NOT EXISTS "daily_rank" (
+    "create_at"	TEXT,
+    "rank"	INTEGER,
+    "id"	INTEGER,
+    "popularity"	REAL,
+    PRIMARY KEY("create_at","rank")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "daily_rank_id" ON "daily_rank" ("id", "create_at");
+"""
+INSERT_SQL = "INSERT INTO popularity (id,original_name,popularity,create_at) VALUES(?,?,?,?)"
+
 parser = argparse.ArgumentParser()
 group = parser.add_mutually_exclusive_group()
 group.add_argument("-f", "--file", help="指定读取的文件名")
 group.add_argument("-p", "--path", help="指定读取目录下所有文件", default="data")
+parser.add_argument("-d", "--db", help="输出的数据库文件", default="tv.db")
+parser.add_argument("-b", "--batch-size", help="每次executemany写入的行数",
+                    default=10000, type=int)
+parser.add_argument("--parquet", help="同时按日期分区输出Parquet文件的目录，需要安装pyarrow")
+parser.add_argument("--force", help="重新导入已经存在的日期", action="store_true")
+parser.add_argument("-j", "--jobs", help="并行解析文件的进程数，默认不使用进程池", type=int)
 
 
-def file2db(fpath: Path, conn)->None:
-    """把文件名为fpath的文件写入数据库tv.db
-
-    fpath是Path对象
-    """
-    logging.info(f"reading {fpath}...")
+def file_date(fpath: Path)->str:
+    """返回数据库中使用的日期字符串，与analysis_daily_export.py的查询一致"""
     month, day, year = map(int, FILENAME_RE.match(fpath.name).groups())
-    date = f"{year}-{month}-{day}"
+    return f"{year}-{month}-{day}"
+
+
+def read_rows(fpath: Path, date):
+    """流式解压并逐行解析，生成(id, original_name, popularity, create_at)"""
+    loads = json.loads
     with gzip.open(fpath, "rb") as f:
         for line in f:
-            d = json.loads(line.decode("utf8"))
-            conn.execute(
-                sql, (d["id"], d["original_name"], d["popularity"], date))
-    conn.commit()
+            d = loads(line)
+            yield d["id"], d["original_name"], d["popularity"], date
+
+
+def batched(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def init_db(conn)->None:
+    conn.executescript(SCHEMA)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+
+def is_loaded(conn, date)->bool:
+    return conn.execute(
+        "SELECT 1 FROM popularity WHERE create_at=? LIMIT 1", (date,)).fetchone() is not None
+
+
+def write_parquet(root: Path, date, columns)->None:
+    """写入root/create_at=日期/part-0.parquet，与pyarrow的hive分区格式相同"""
+    partition = root/f"create_at={date}"
+    partition.mkdir(parents=True, exist_ok=True)
+    table = pa.table({
+        "id": pa.array(columns[0], pa.int64()),
+        "original_name": pa.array(columns[1], pa.string()),
+        "popularity": pa.array(columns[2], pa.float64()),
+    })
+    pq.write_table(table, partition/"part-0.parquet")
+
+
+def write_rows(conn, date, rows, batch_size=10000, parquet=None, force=False)->int:
+    """把同一天的rows写入数据库，整天的数据在一个事务中分批写入
+
+    中途失败不会留下半天的数据，返回写入的行数。
+    """
+    count = 0
+    columns = ([], [], []) if parquet else None
+    with conn:
+        if force:
+            conn.execute("DELETE FROM popularity WHERE create_at=?", (date,))
+            conn.execute("DELETE FROM daily_rank WHERE create_at=?", (date,))
+        for batch in batched(rows, batch_size):
+            conn.executemany(INSERT_SQL, batch)
+            count += len(batch)
+            if columns:
+                for column, values in zip(columns, zip(*batch)):
+                    column.extend(values)
+    if parquet:
+        write_parquet(Path(parquet), date, columns)
+    return count
+
+
+def file2db(fpath: Path, conn, batch_size=10000, parquet=None, force=False)->int:
+    """把文件名为fpath的文件写入数据库
+
+    fpath是Path对象。已经导入过的日期会被跳过，返回写入的行数。
+    """
+    date = file_date(fpath)
+    if not force and is_loaded(conn, date):
+        logging.info(f"skip {fpath}, {date} already loaded")
+        return 0
+    logging.info(f"reading {fpath}...")
+    start_time = time.perf_counter()
+    count = write_rows(conn, date, read_rows(fpath, date), batch_size, parquet, force)
+    elapsed = time.perf_counter()-start_time
+    logging.info(
+        f"{fpath} loaded: {count} rows in {elapsed:.2f}s ({count/max(elapsed, 1e-9):.0f} rows/s)")
+    return count
+
+
+def decode_file(fpath: Path):
+    """在子进程中解压并解析整个文件"""
+    date = file_date(fpath)
+    return date, list(read_rows(fpath, date))
+
+
+def files2db(fpaths, conn, jobs=None, batch_size=10000, parquet=None, force=False)->int:
+    """用进程池并行解析多个文件，由当前进程作为唯一的写入者
+
+    同时解析的文件数不超过进程数的两倍，以限制内存占用。返回写入的总行数。
+    """
+    todo = []
+    for fpath in fpaths:
+        if not force and is_loaded(conn, file_date(fpath)):
+            logging.info(f"skip {fpath}, {file_date(fpath)} already loaded")
+        else:
+            todo.append(fpath)
+    jobs = jobs or os.cpu_count()
+    todo.reverse()
+    files = len(todo)
+    finished = 0
+    total = 0
+    start_time = time.perf_counter()
+    with futures.ProcessPoolExecutor(jobs) as executor:
+        pending = set()
+        while todo or pending:
+            while todo and len(pending) < 2*jobs:
+                pending.add(executor.submit(decode_file, todo.pop()))
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                date, rows = future.result()
+                total += write_rows(conn, date, rows, batch_size, parquet, force)
+                finished += 1
+            elapsed = time.perf_counter()-start_time
+            logging.info(
+                f"[{finished}/{files}] {total} rows loaded in {elapsed:.2f}s ({total/max(elapsed, 1e-9):.0f} rows/s)")
+    return total
 
 
 if __name__ == "__main__":
-    conn = sqlite3.connect("tv.db")
-    sql = "INSERT INTO popularity (id,original_name,popularity,create_at) VALUES(?,?,?,?)"
     arg = parser.parse_args()
+    if arg.parquet and pa is None:
+        parser.error("输出Parquet需要安装pyarrow")
+    conn = sqlite3.connect(arg.db)
+    init_db(conn)
     if arg.file:
-        file2db(Path(arg.file), conn)
+        fpaths = [Path(arg.file)]
+    else:
+        fpaths = sorted(Path(arg.path).glob("*.gz"))
+    fpaths = [fpath for fpath in fpaths if FILENAME_RE.match(fpath.name)]
+    if arg.jobs:
+        files2db(fpaths, conn, arg.jobs, arg.batch_size, arg.parquet, arg.force)
     else:
-        for fpath in Path(arg.path).glob("*.gz"):
-            file2db(fpath, conn)
+        for fpath in fpaths:
+            file2db(fpath, conn, arg.batch_size, arg.parquet, arg.force)
     conn.close()
@@ -0,0 +1,18 @@
+from pathlib import Path
+from local_server import StandInServer, Config
+import pytest
+
+PLOTS = Path(__file__).parent/"plots"
+
+
+@pytest.fixture(scope="module")
+def stand_in():
+    with StandInServer() as server:
+        yield server
+
+
+@pytest.fixture(scope="module")
+def recorded():
+    """以tests/plots中录制的剧情页面作为fixtures的替身服务器，/2.html返回plots/2.html"""
+    with StandInServer(config=Config(fixtures=PLOTS)) as server:
+        yield server
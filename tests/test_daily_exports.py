@@ -0,0 +1,40 @@
+from datetime import date
+import sqlite3
+from local_server import tmdb_export
+from read_daily_exports import file2db, files2db, init_db
+import pytest
+
+
+@pytest.fixture
+def exports(tmp_path):
+    for day in (1, 2):
+        cur_date = date(2020, 1, day)
+        fpath = tmp_path/cur_date.strftime("tv_series_ids_%m_%d_%Y.json.gz")
+        fpath.write_bytes(tmdb_export(cur_date))
+    return sorted(tmp_path.glob("*.gz"))
+
+
+def test_file2db(exports):
+    conn = sqlite3.connect(":memory:")
+    init_db(conn)
+    assert [file2db(f, conn, batch_size=300) for f in exports] == [2000, 2000]
+    assert file2db(exports[0], conn) == 0
+    assert file2db(exports[0], conn, force=True) == 2000
+    rows = conn.execute(
+        "SELECT create_at,count(*) FROM popularity GROUP BY create_at ORDER BY create_at").fetchall()
+    assert rows == [("2020-1-1", 2000), ("2020-1-2", 2000)]
+    top = conn.execute(
+        "SELECT id FROM popularity WHERE create_at=? ORDER BY popularity DESC LIMIT 3", ("2020-1-2",)).fetchall()
+    assert top == [(1,), (2,), (3,)]
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM popularity WHERE create_at=? ORDER BY popularity DESC LIMIT 10", ("2020-1-2",)))
+    assert "popularity_date" in plan
+
+
+def test_files2db(exports):
+    conn = sqlite3.connect(":memory:")
+    init_db(conn)
+    file2db(exports[0], conn)
+    assert files2db(exports, conn, jobs=2) == 2000
+    assert conn.execute("SELECT count(*) FROM popularity").fetchone() == (4000,)
+    assert files2db(exports, conn, jobs=2) == 0
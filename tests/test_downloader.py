@@ -0,0 +1,27 @@
+from datetime import date
+from local_server import tmdb_export
+from popularity_downloader import download, is_valid_gzip
+
+
+def test_download_resume(stand_in, tmp_path):
+    url = stand_in.url+"/p/exports/tv_series_ids_%m_%d_%Y.json.gz"
+    cur_date = date(2020, 1, 2)
+    body = tmdb_export(cur_date)
+    target = tmp_path/"tv_series_ids_01_02_2020.json.gz"
+    part = tmp_path/"tv_series_ids_01_02_2020.json.gz.part"
+    part.write_bytes(body[:len(body)//2])
+    assert not is_valid_gzip(part)
+
+    assert download(cur_date, tmp_path, url).startswith("成功")
+    assert target.read_bytes() == body
+    assert not part.exists()
+    assert stand_in.stats()["206"] == 1
+
+    total = stand_in.stats()["total"]
+    assert download(cur_date, tmp_path, url).endswith("已经存在")
+    assert stand_in.stats()["total"] == total
+
+    # 损坏的文件会被重新下载
+    target.write_bytes(body[:100])
+    assert download(cur_date, tmp_path, url).startswith("成功")
+    assert is_valid_gzip(target)
@@ -0,0 +1,164 @@
+import csv
+import pytest
+from graph_loader import GraphBatch, Neo4jLoader, CsvExporter, GraphLoader, GraphQuery
+
+
+class RecordingGraph:
+    """记录执行的Cypher语句，代替真实的Neo4j连接"""
+
+    def __init__(self):
+        self.statements = []
+        self.committed = 0
+
+    def begin(self):
+        return self
+
+    def run(self, cypher, **params):
+        self.statements.append((cypher, params))
+        return []
+
+    def commit(self):
+        self.committed += 1
+
+    def rollback(self):
+        pass
+
+
+def make_batch():
+    batch = GraphBatch()
+    for show in (1, 2):
+        batch.add_node("tv", show, name=f"tv{show}")
+        batch.add_node("country", "KR")
+        batch.add_rel("tv", show, "origin_country", "country", "KR")
+        for person in (10, 11):
+            batch.add_rel("tv", show, "cast", "cast", person, character="x", order=0)
+    batch.add_node("country", "KR", name="ignored")
+    return batch
+
+
+def test_graph_batch():
+    batch = make_batch()
+    assert batch.nodes["country"] == {"KR": {}}
+    assert len(batch.rels["tv", "cast", "cast"]) == 4
+    other = GraphBatch()
+    other.add_node("tv", 1, name="changed")
+    other.add_node("tv", 3, name="tv3")
+    batch.update(other)
+    assert batch.nodes["tv"] == {1: {"name": "tv1"}, 2: {"name": "tv2"}, 3: {"name": "tv3"}}
+    assert len(batch) == 4+2+4
+    batch.clear()
+    assert len(batch) == 0
+
+
+def test_neo4j_loader():
+    graph = RecordingGraph()
+    Neo4jLoader(graph, batch_size=3).write(make_batch())
+    assert graph.committed == 1
+    cyphers = [cypher for cypher, _ in graph.statements]
+    # 节点在关系之前写入，同一标签或关系类型的行合并为一条语句
+    assert [c.split()[5] for c in cyphers[:2]] == ["(n:`tv`", "(n:`country`"]
+    assert len(cyphers) == 2+1+2
+    rows = graph.statements[3][1]["rows"]+graph.statements[4][1]["rows"]
+    assert {(row["start"], row["end"]) for row in rows} == {(1, 10), (1, 11), (2, 10), (2, 11)}
+
+
+def test_node_cache():
+    graph = RecordingGraph()
+    loader = Neo4jLoader(graph)
+    loader.write(make_batch())
+    assert ("country", "KR") in loader.cache
+    graph.statements.clear()
+    batch = GraphBatch()
+    batch.add_node("country", "KR")
+    batch.add_node("tv", 3, name="tv3")
+    batch.add_rel("tv", 3, "origin_country", "country", "KR")
+    loader.write(batch)
+    # 已经写入过的节点不再MERGE
+    assert [c.split()[5] for c, _ in graph.statements] == ["(n:`tv`", "(a:`tv`"]
+    assert graph.statements[0][1]["rows"] == [{"id": 3, "props": {"name": "tv3"}}]
+    assert loader.existing_ids("tv", [1, 3]) == {1, 3}
+    assert len(graph.statements) == 2
+
+
+def test_csv_exporter(tmp_path):
+    exporter = CsvExporter(tmp_path)
+    exporter.write(make_batch())
+    batch = GraphBatch()
+    batch.add_node("cast", 10, name="演员, 10", popularity=1.5)
+    batch.add_node("cast", 11, name="演员11", popularity=2)
+    batch.add_rel("tv", 1, "is", "genre", 18)
+    exporter.write(batch)
+    assert exporter.existing_ids("cast", [10, 12]) == {10}
+    command = exporter.close()
+    assert "--nodes=nodes_tv.csv" in command
+    assert "rels_tv_is_genre.csv" not in command
+    with open(tmp_path/"nodes_cast.csv", encoding="utf8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == [":ID(cast)", "id:long", "name", "popularity:double", ":LABEL"]
+    assert rows[1] == ["10", "10", "演员, 10", "1.5", "cast"]
+    with open(tmp_path/"rels_tv_cast_cast.csv", encoding="utf8") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == [":START_ID(tv)", ":END_ID(cast)", "character", "order:long", ":TYPE"]
+    assert len(rows) == 5
+
+
+def test_set_node():
+    batch = GraphBatch()
+    batch.add_node("tv", 1, name="tv1", popularity=1.0)
+    batch.set_node("tv", 1, popularity=2.0)
+    other = GraphBatch()
+    other.set_node("tv", 1, popularity=3.0)
+    batch.update(other)
+    assert batch.updates["tv"] == {1: {"popularity": 3.0}}
+    graph = RecordingGraph()
+    Neo4jLoader(graph).write(batch)
+    cypher, params = graph.statements[1]
+    assert "SET n += row.props" in cypher and "ON CREATE" not in cypher
+    assert params["rows"] == [{"id": 1, "props": {"popularity": 3.0}}]
+
+
+class Neo4jError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class LegacyGraph(RecordingGraph):
+    """不支持IF NOT EXISTS的旧版本服务器，country的约束已经存在"""
+
+    def run(self, cypher, **params):
+        if "IF NOT EXISTS" in cypher:
+            raise Neo4jError("Neo.ClientError.Statement.SyntaxError")
+        if "`country`" in cypher:
+            raise Neo4jError("Neo.ClientError.Schema.ConstraintAlreadyExists")
+        return super().run(cypher, **params)
+
+
+def test_ensure_constraints():
+    graph = RecordingGraph()
+    Neo4jLoader(graph).ensure_constraints(("tv", "country"))
+    assert all("IF NOT EXISTS" in cypher for cypher, _ in graph.statements)
+
+    graph = LegacyGraph()
+    Neo4jLoader(graph).ensure_constraints(("tv", "country", "cast"))
+    assert [cypher for cypher, _ in graph.statements] == [
+        "CREATE CONSTRAINT ON (n:`tv`) ASSERT n.id IS UNIQUE",
+        "CREATE CONSTRAINT ON (n:`cast`) ASSERT n.id IS UNIQUE",
+    ]
+
+    # 认证或连接错误不会被当作语法错误重试
+    class BrokenGraph(RecordingGraph):
+        def run(self, cypher, **params):
+            raise ConnectionError("connection refused")
+
+    with pytest.raises(ConnectionError):
+        Neo4jLoader(BrokenGraph()).ensure_constraints()
+
+
+def test_interfaces(tmp_path):
+    loader = Neo4jLoader(RecordingGraph())
+    assert isinstance(loader, GraphLoader) and isinstance(loader, GraphQuery)
+    exporter = CsvExporter(tmp_path)
+    assert isinstance(exporter, GraphLoader) and not isinstance(exporter, GraphQuery)
+    with pytest.raises(TypeError):
+        GraphLoader()
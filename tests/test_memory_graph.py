@@ -0,0 +1,83 @@
+from graph_loader import GraphBatch
+from memory_graph import MemoryGraph
+
+
+def make_graph_batch():
+    batch = GraphBatch()
+    batch.add_node("genre", 18, name="剧情")
+    # 演员10和11同时出演1和2，演员12只出演2，演员13只出演3
+    casts = {1: (10, 11), 2: (10, 11, 12), 3: (12, 13), 4: (14,)}
+    for show, people in casts.items():
+        batch.add_node("tv", show, name=f"tv{show}")
+        if show != 4:
+            batch.add_rel("tv", show, "is", "genre", 18)
+        for person in people:
+            batch.add_node("cast", person, name=f"演员{person}")
+            batch.add_rel("tv", show, "cast", "cast", person, character="x", order=0)
+    batch.add_rel("tv", 1, "is", "genre", 35)
+    return batch
+
+
+def make_graph():
+    graph = MemoryGraph()
+    graph.write(make_graph_batch())
+    return graph
+
+
+def check_queries(graph):
+    assert graph.co_stars(10) == [(11, 2), (12, 1)]
+    assert graph.shows_by_genre(18) == [1, 2, 3]
+    assert graph.shows_by_genre(35) == []
+    assert graph.shortest_path(10, 13) == [
+        ("cast", 10), ("tv", 2), ("cast", 12), ("tv", 3), ("cast", 13)]
+    assert graph.shortest_path(10, 14) is None
+    assert graph.node("cast", 12) == {"id": 12, "name": "演员12"}
+
+
+def test_queries():
+    graph = make_graph()
+    assert len(graph) == 1+4+5
+    assert graph.existing_ids("cast", [10, 99]) == {10}
+    check_queries(graph)
+
+
+def test_mmap_persistence(tmp_path):
+    filename = tmp_path/"graph.bin"
+    graph = make_graph()
+    graph.filename = filename
+    graph.close()
+
+    graph = MemoryGraph.load(filename)
+    check_queries(graph)
+    # 加载后仍然可以继续写入
+    batch = GraphBatch()
+    batch.add_node("tv", 5, name="tv5")
+    batch.add_rel("tv", 5, "cast", "cast", 14)
+    batch.add_rel("tv", 5, "cast", "cast", 13)
+    graph.write(batch)
+    assert graph.shortest_path(10, 14)[-2:] == [("tv", 5), ("cast", 14)]
+    graph.close()
+
+
+def test_incremental_update(tmp_path):
+    filename = tmp_path/"graph.bin"
+    graph = MemoryGraph.open(filename)
+    graph.write(make_graph_batch())
+    graph.close()
+
+    graph = MemoryGraph.open(filename)
+    assert graph.get_nodes("tv", [1, 99]) == {1: {"name": "tv1"}}
+    batch = make_graph_batch()
+    batch.set_node("tv", 1, popularity=5.0)
+    batch.set_node("tv", 9, name="tv9", popularity=1.0)
+    batch.add_rel("tv", 9, "cast", "cast", 10)
+    graph.write(batch)
+    graph.close()
+
+    graph = MemoryGraph.load(filename)
+    assert graph.get_nodes("tv", [1, 9]) == {
+        1: {"name": "tv1", "popularity": 5.0}, 9: {"name": "tv9", "popularity": 1.0}}
+    # 重复写入同样的关系不会产生重复的边
+    assert len(graph.arrays["edge_src"]) == len(make_graph().edges)+1
+    assert graph.co_stars(10) == [(11, 2), (12, 1)]
+    graph.close()
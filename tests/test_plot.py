@@ -1,4 +1,11 @@
-from plot_crawler import PlotParser, Urls, PlotScheduler
+from plot_crawler import PlotParser, Urls, PlotScheduler, AsyncPlotScheduler, PageNotFoundException
+from plot_crawler import Output, PlotWriter, Plot_para, PersistentUrls, ResponseCache, page_range
+from plot_crawler import Scheduler, Download, AsyncDownload
+import sqlite3
+from local_server import StandInServer, Config
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession
+import asyncio
+import threading
 import pytest
 from lxml import etree
 import pdb
@@ -65,11 +72,12 @@ def test_links(filename, links):
 
 
 @pytest.mark.parametrize(
-    "base_url,episodes", [
-        ("http://www.bjxyxd.com/3/50417.html", 12)
+    "path,episodes", [
+        ("/3/50417.html", 12)
     ]
 )
-def test_episodes(base_url, episodes):
+def test_episodes(stand_in, path, episodes):
+    base_url = stand_in.url+path
     urls = Urls()
     urls.add_urls([base_url, ])
     scheduler = PlotScheduler(urls)
@@ -78,3 +86,224 @@ def test_episodes(base_url, episodes):
         plot = next(plots)
         print(plot)
         assert plot.episode == str(ep)
+
+
+@pytest.mark.parametrize(
+    "filename,titles", [
+        ("2.html", ["案件发生帅气警官变花样爷爷", "新婚夫妇被杀案件"]),
+        ("5.html", ["朴达乡入京科考", "大元帅金自点秘谋造反"]),
+    ]
+)
+def test_recorded_pages(recorded, filename, titles):
+    url = f"{recorded.url}/{filename}"
+    parser = PlotParser("test", Download().download(url), url, Urls())
+    assert [plot.title for plot in parser.get_plots()][:2] == titles
+
+
+class FakeAsyncDownload:
+    """用本地文件模拟网站，pages以外的页面返回404"""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    async def download(self, url, encodeing="gbk"):
+        if url not in self.pages:
+            raise PageNotFoundException()
+        with open(self.pages[url], "r", encoding=encodeing) as f:
+            return f.read()
+
+
+def test_async_plots():
+    urls = Urls()
+    download = FakeAsyncDownload({
+        "base.html": make_filename("2.html"),
+        "base_2.html": make_filename("5.html"),
+    })
+    scheduler = AsyncPlotScheduler(urls, download, window=2)
+    plots = asyncio.run(scheduler.get_plots("base", "test"))
+    assert [plot.title for plot in plots[:2]] == [
+        "案件发生帅气警官变花样爷爷", "新婚夫妇被杀案件"]
+    assert "朴达乡入京科考" in [plot.title for plot in plots]
+
+
+def test_async_blocking_callback():
+    urls = Urls()
+    urls.add_urls([("base.html", "test")])
+    download = FakeAsyncDownload({"base.html": make_filename("2.html")})
+    scheduler = AsyncPlotScheduler(urls, download)
+    released = threading.Event()
+    results = []
+
+    def callback(plots):
+        # 模拟写入队列已满，阻塞到事件循环中的其他协程放行
+        results.append(released.wait(2))
+
+    async def release():
+        await asyncio.sleep(0.05)
+        released.set()
+
+    async def run():
+        await asyncio.gather(scheduler.run(callback), release())
+
+    asyncio.run(run())
+    assert results == [True]
+    assert urls.is_done("base.html")
+
+
+def test_failed_pages(stand_in):
+    # 第一页不存在的剧集记为完成，不会中断爬取
+    missing = (stand_in.url+"/3/missing.html", "missing")
+    urls = Urls()
+    urls.add_urls([missing])
+    assert list(PlotScheduler(urls).run()) == []
+    assert urls.is_done(missing[0]) and not urls.fail
+
+    urls = Urls()
+    urls.add_urls([("base.html", "test")])
+    scheduler = AsyncPlotScheduler(urls, FakeAsyncDownload({}))
+    asyncio.run(scheduler.run(lambda plots: None))
+    assert urls.is_done("base.html") and not urls.fail
+
+    # 重试用完之后仍然返回500的剧集进入失败队列，而不是被当作没有剧情的页面
+    with StandInServer(config=Config(error_rate=1.0)) as server:
+        item = (server.url+"/3/10000.html", "剧集10000")
+        urls = Urls()
+        urls.add_urls([item])
+        session = RateLimitedSession(RateLimiter(1000), RetryPolicy(0))
+        assert list(PlotScheduler(urls, session=session).run()) == []
+        assert not urls.is_done(item[0]) and item in urls.fail
+
+        async def run():
+            async with AsyncDownload(limiter=RateLimiter(1000), policy=RetryPolicy(0)) as download:
+                await AsyncPlotScheduler(urls, download).run(lambda plots: None)
+
+        urls = Urls()
+        urls.add_urls([item])
+        asyncio.run(run())
+        assert not urls.is_done(item[0]) and item in urls.fail
+
+
+def test_plot_writer(tmp_path):
+    filename = str(tmp_path/"tv.db")
+    plots = [Plot_para("test", str(i), "", "detail", "url")
+             for i in range(25)]
+    with PlotWriter(Output(), filename, batch_size=10, queue_size=5) as writer:
+        writer.put_many(plots)
+    assert writer.count == 25
+    conn = sqlite3.connect(filename)
+    assert conn.execute("SELECT count(*) FROM plots").fetchone()[0] == 25
+    conn.close()
+
+
+def test_persistent_urls(tmp_path):
+    filename = str(tmp_path/"frontier.db")
+    with PersistentUrls(filename, checkpoint=2, backoff=0) as urls:
+        urls.add_urls([("a.html", "A"), ("b.html", "B"), ("c.html", "C"), None])
+        urls.done_url(("a.html", "A"))
+        urls.fail_url(("b.html", "B"))
+    with PersistentUrls(filename) as urls:
+        assert urls.resumed
+        assert urls.is_done("a.html")
+        assert urls.todo == {("c.html", "C")}
+        urls.add_urls([("a.html", "A")])
+        assert urls.todo == {("c.html", "C")}
+        assert urls.retry_failed() == 0
+        assert ("b.html", "B") in urls.todo
+
+
+def test_resumed_discovery(stand_in, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    frontier = str(tmp_path/"frontier.db")
+    index_url = stand_in.url+"/3/list_3.html"
+    # 模拟在索引第一页之后中断的运行
+    with PersistentUrls(frontier) as urls:
+        urls.add_urls([(f"{stand_in.url}/3/10000.html", "剧集10000")])
+        urls.done_url((f"{stand_in.url}/3/10000.html", "剧集10000"))
+    Scheduler(frontier=frontier, index_url=index_url, rate=1000).crawler()
+    with PersistentUrls(frontier) as urls:
+        assert not urls.todo and not urls.fail
+        assert len(urls.done) == 60
+    conn = sqlite3.connect(str(tmp_path/"tv.db"))
+    assert conn.execute("SELECT count(DISTINCT show_name) FROM plots").fetchone()[0] == 59
+    conn.close()
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path/"cache.db"), ttl=60)
+    assert cache.get("a.html") is None
+    cache.put("a.html", "剧情".encode("gbk"), etag='"abc"')
+    cached = cache.get("a.html")
+    assert cached.fresh and cached.body.decode("gbk") == "剧情"
+    assert ResponseCache.conditional_headers(cached) == {
+        "If-None-Match": '"abc"'}
+    assert page_range(cache, "base", 100) == range(2, 100)
+    cache.set_last_page("base", 5)
+    assert page_range(cache, "base", 100) == range(2, 6)
+    cache.close()
+
+
+def test_revalidation(stand_in, tmp_path):
+    url = stand_in.url+"/3/50418.html"
+    # ttl为0，每次都要向服务器重新验证
+    cache = ResponseCache(str(tmp_path/"cache.db"), ttl=0)
+    download = Download(cache)
+    html = download.download(url)
+    assert cache.get(url).etag and cache.get(url).last_modified
+    before = stand_in.stats()
+    assert download.download(url) == html
+    after = stand_in.stats()
+    assert after.get("304", 0) == before.get("304", 0)+1
+    assert after.get("200") == before.get("200")
+
+    async def run():
+        async with AsyncDownload(cache=cache) as download:
+            return await download.download(url)
+
+    assert asyncio.run(run()) == html
+    assert stand_in.stats().get("304") == after["304"]+1
+    # 没有缓存时正常返回内容
+    assert Download().download(url) == html
+    cache.close()
+
+
+def test_output_upsert(tmp_path):
+    filename = str(tmp_path/"tv.db")
+    conn = sqlite3.connect(filename)
+    conn.execute(
+        "CREATE TABLE plots (show_name,episode,title,detail,edit_time,url)")
+    conn.execute(
+        "INSERT INTO plots VALUES ('old','1','t','d','http://a.html','2020-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+    with Output().open_db(filename) as output:
+        assert output.get_plots("old") == [
+            Plot_para("old", "1", "t", "d", "http://a.html")]
+        plots = [Plot_para("test", "1", "t", "d", "url"),
+                 Plot_para("test", "2", "t", "d", "url")]
+        assert output.store_to_db(plots) == 2
+        assert output.store_to_db(plots) == 0
+        assert output.store_to_db(
+            [Plot_para("test", "2", "t", "new", "url")]) == 1
+        assert [plot.detail for plot in output.get_plots("test")] == ["d", "new"]
+
+
+def test_output_key_migration(tmp_path):
+    filename = str(tmp_path/"tv.db")
+    conn = sqlite3.connect(filename)
+    conn.executescript("""
+    CREATE TABLE plots (show_name,episode,title,detail,edit_time,url,content_hash,
+        PRIMARY KEY("show_name","episode"));
+    CREATE INDEX plots_url ON plots (url);
+    INSERT INTO plots VALUES ('test','0','t','d','2020-01-01 00:00:00','a.html','hash');
+    """)
+    conn.close()
+    with Output().open_db(filename) as output:
+        assert output.conn.execute("SELECT content_hash FROM plots").fetchone() == ("hash",)
+        # 不同页面上集数无法识别的剧情不会互相覆盖
+        plots = [Plot_para("test", "0", "t", "d", "a.html"),
+                 Plot_para("test", "0", "t2", "d2", "b.html")]
+        assert output.store_to_db(plots) == 2
+        assert len(output.get_plots("test")) == 2
+        assert output.store_to_db(plots) == 0
+        assert output.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND name='plots_url'").fetchone()
@@ -0,0 +1,44 @@
+from datetime import date, timedelta
+import sqlite3
+from local_server import tmdb_export
+from popularity_query import PopularityRanking
+from read_daily_exports import file2db, init_db
+import pytest
+
+
+@pytest.fixture
+def ranking(tmp_path):
+    conn = sqlite3.connect(":memory:")
+    init_db(conn)
+    for n in range(7):
+        cur_date = date(2020, 1, 1)+timedelta(days=n)
+        fpath = tmp_path/cur_date.strftime("tv_series_ids_%m_%d_%Y.json.gz")
+        fpath.write_bytes(tmdb_export(cur_date))
+        file2db(fpath, conn)
+    return PopularityRanking(conn, depth=50)
+
+
+def test_top_n(ranking):
+    dates = [date(2020, 1, 1)+timedelta(days=n) for n in range(7)]
+    top = ranking.top_n(dates, 3)
+    assert list(top) == dates
+    assert [id for id, _ in top[dates[0]]] == [1, 2, 3]
+    expected = ranking.conn.execute(
+        "SELECT id,popularity FROM popularity WHERE create_at='2020-1-4' ORDER BY popularity DESC LIMIT 3").fetchall()
+    assert top[dates[3]] == expected
+    assert ranking.ensure(dates) == 0
+    assert ranking.top_n([date(2021, 1, 1)], 3) == {date(2021, 1, 1): []}
+
+
+def test_rank_changes_and_trend(ranking):
+    dates = [date(2020, 1, 2), date(2020, 1, 3)]
+    changes = ranking.rank_changes(dates, 2)
+    assert changes[dates[0]] == [(1, 1, 1), (2, 2, 2)]
+    trend = ranking.trend([1, 60, 99999], dates)
+    # 趋势不受depth限制
+    assert trend[60] == [p for p, in ranking.conn.execute(
+        "SELECT popularity FROM popularity WHERE id=60 AND create_at IN ('2020-1-2','2020-1-3') "
+        "ORDER BY create_at")]
+    assert None not in trend[60]
+    assert trend[99999] == [None, None]
+    assert trend[1] == [p for ((id, p), *_) in ranking.top_n(dates, 1).values()]
@@ -0,0 +1,54 @@
+import time
+from concurrent import futures
+from rate_limit import RateLimiter, RetryPolicy, RateLimitedSession
+from local_server import StandInServer, Config
+
+
+def test_aimd():
+    limiter = RateLimiter(rate=10, max_rate=12)
+    limiter.feedback(429)
+    assert limiter.rate == 5
+    limiter.feedback(503, sent_at=time.monotonic())
+    assert limiter.rate == 2.5
+    for _ in range(500):
+        limiter.feedback(200)
+    assert limiter.rate == 12
+    for _ in range(20):
+        limiter.feedback(500, sent_at=time.monotonic())
+    assert limiter.rate == limiter.min_rate
+
+
+def test_concurrent_burst():
+    limiter = RateLimiter(rate=20)
+    sent_at = time.monotonic()
+    # 32个同时发出的请求都收到429，只降速一次
+    with futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: limiter.feedback(429, sent_at=sent_at), range(32)))
+    assert limiter.rate == 10
+    # 降速之后发出的请求再次失败时继续降速
+    limiter.feedback(429, sent_at=time.monotonic())
+    assert limiter.rate == 5
+    # 没有发送时间时，短时间内的多次失败也只降速一次
+    limiter = RateLimiter(rate=20)
+    for _ in range(32):
+        limiter.feedback(429)
+    assert limiter.rate == 10
+
+
+def test_retry_delay():
+    policy = RetryPolicy(retries=2, base=1, cap=3)
+    assert all(0 <= policy.delay(n) <= 3 for n in range(10))
+    assert policy.should_retry(0, 503)
+    assert not policy.should_retry(0, 404)
+    assert not policy.should_retry(2, 503)
+
+
+def test_session_retry():
+    config = Config(error_rate=0.5, seed=1)
+    with StandInServer(config=config) as server:
+        session = RateLimitedSession(
+            RateLimiter(rate=1000), RetryPolicy(retries=20, base=0))
+        for _ in range(5):
+            r = session.get(server.url+"/3/tv/1")
+            assert r.status_code == 200
+        assert server.stats().get("500", 0) > 0
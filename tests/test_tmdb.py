@@ -0,0 +1,179 @@
+from TMDBapi import TMDBApi, AsyncTMDBApi, ExportIndex
+import asyncio
+import gzip
+import sqlite3
+from datetime import date
+import threading
+import time
+from concurrent import futures
+from TMDBapi.cache import ApiCache, SingleFlight
+from local_server import StandInServer, Config, tmdb_export
+import pytest
+
+
+def test_persistent_cache(stand_in, tmp_path):
+    filename = str(tmp_path/"cache.db")
+    api = TMDBApi("key", "zh-CN", base_url=stand_in.url+"/3", cache=filename)
+    assert api.get_tv_details(1)["name"] == "tv1"
+    assert api.get_details(1, "tv")["name"] == "tv1"
+    assert api.cache.stats()["hits"] == 1
+    api.cache.close()
+
+    total = stand_in.stats()["total"]
+    api = TMDBApi("key", "zh-CN", base_url=stand_in.url+"/3", cache=filename)
+    assert api.get_details(id=1, target="tv")["name"] == "tv1"
+    assert stand_in.stats()["total"] == total
+
+
+def test_cache_eviction():
+    cache = ApiCache(max_bytes=200)
+    for i in range(20):
+        cache.put("details", str(i), {"id": i, "name": "x"*50})
+    assert cache.size <= 200
+    assert cache.evictions > 0
+    assert cache.get("details", "19") == {"id": 19, "name": "x"*50}
+    assert cache.get("details", "0") is None
+    assert cache.get("unknown", "19") is None
+
+
+def test_cache_shared_file(tmp_path):
+    filename = str(tmp_path/"cache.db")
+    first = ApiCache(filename, commit_every=1000)
+    second = ApiCache(filename)
+    # 写入立即提交，另一个进程可以同时写入和读取
+    first.put("details", "a", {"id": 1})
+    second.put("details", "b", {"id": 2})
+    assert second.get("details", "a") == {"id": 1}
+    time.sleep(0.01)
+    assert first.get("details", "a") == {"id": 1}
+    other = sqlite3.connect(filename)
+    accessed = dict(other.execute("SELECT key,accessed FROM cache"))
+    assert accessed["a"] < accessed["b"]
+    # 数据库被锁定时写入被放弃，读取仍然可以进行
+    other.execute("BEGIN IMMEDIATE")
+    second.conn.execute("PRAGMA busy_timeout=10")
+    second.put("details", "c", {"id": 3})
+    assert second.get("details", "c") is None
+    assert second.get("details", "b") == {"id": 2}
+    other.rollback()
+    # 命中时记录的访问时间在close时写入
+    first.close()
+    accessed = dict(other.execute("SELECT key,accessed FROM cache"))
+    assert accessed["a"] > accessed["b"]
+    second.close()
+    other.close()
+
+
+def test_async_popular(stand_in):
+    async def run():
+        async with AsyncTMDBApi("key", "zh-CN", base_url=stand_in.url+"/3", rate=1000) as api:
+            top = await api.get_popular_list("tv", limit=45)
+            details = await api.get_many_details([item["id"] for item in top[:10]], "tv")
+            return top, details
+
+    top, details = asyncio.run(run())
+    assert [item["id"] for item in top] == list(range(1, 46))
+    assert [d["name"] for d in details] == [f"tv{i}" for i in range(1, 11)]
+
+
+def test_async_failed_details():
+    async def run():
+        async with AsyncTMDBApi("key", "zh-CN", base_url=server.url+"/3", rate=1000,
+                                retry=0) as api:
+            return await api.get_many_details([1, 2, 3], "tv")
+
+    with StandInServer(config=Config(error_rate=1.0)) as server:
+        # 失败的条目为None，不会中断其他条目，也不会被缓存
+        assert asyncio.run(run()) == [None, None, None]
+        server.config.error_rate = 0
+        assert [d["name"] for d in asyncio.run(run())] == ["tv1", "tv2", "tv3"]
+
+
+def test_full_details(stand_in):
+    api = TMDBApi("key", "zh-CN", base_url=stand_in.url+"/3")
+    total = stand_in.stats()["total"]
+    info = api.get_full_details(3, "tv")
+    assert info["name"] == "tv3"
+    assert info["credits"]["cast"][0]["id"] == 500003
+    assert info["external_ids"]["imdb_id"] == "tt0000003"
+    assert stand_in.stats()["total"] == total+1
+    # 各部分分别缓存
+    assert api.get_tv_details(3)["name"] == "tv3"
+    assert "credits" not in api.get_tv_details(3)
+    assert api.get_tv_credits(3) == info["credits"]
+    assert api.get_external_ids("tv", 3) == info["external_ids"]
+    assert api.get_full_details(3, "tv") == info
+    assert stand_in.stats()["total"] == total+1
+
+    # 只请求缺少的部分
+    api.get_tv_details(4)
+    assert api.get_full_details(4, "tv", ("credits",))["credits"]["id"] == 4
+    assert stand_in.stats()["total"] == total+3
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+    started = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return {"id": 1}
+
+    with futures.ThreadPoolExecutor(8) as executor:
+        first = executor.submit(flight.do, "key", fetch)
+        started.wait()
+        results = list(executor.map(lambda _: flight.do("key", fetch), range(7)))
+    assert first.result() == {"id": 1}
+    assert results == [{"id": 1}]*7
+    assert len(calls) == 1
+    assert flight.coalesced == 7
+    assert not flight.calls
+
+
+def test_coalesced_person_details():
+    with StandInServer(config=Config(latency=0.1)) as server:
+        api = TMDBApi("key", "zh-CN", base_url=server.url+"/3", rate=1000)
+        with futures.ThreadPoolExecutor(8) as executor:
+            people = list(executor.map(lambda _: api.get_person_detail(500001), range(8)))
+        assert all(p["name"] == "演员500001" for p in people)
+        assert server.stats()["total"] == 1
+        stats = api.cache.stats()
+        assert stats["coalesced"]+stats["hits"] == 7
+        assert stats["coalesced"] > 0
+
+
+def test_export_index(stand_in, tmp_path):
+    fpath = tmp_path/"tv_series_ids_01_02_2020.json.gz"
+    fpath.write_bytes(tmdb_export(date(2020, 1, 2)))
+    (tmp_path/"tv_series_ids_01_01_2020.json.gz").write_bytes(gzip.compress(b""))
+    index = ExportIndex.from_dir(tmp_path)
+    assert len(index) == 2000
+    assert index.get(7)["original_name"] == "tv7"
+    assert index.get(99999) is None
+    assert [d["id"] for d in index.search("TV-7")] == [7]
+    assert index.search("tv 7 第二季")[0]["id"] == 7
+    assert index.search("tv1234x")[0]["id"] == 1234
+    assert index.search("完全不同的名字") == []
+
+    api = TMDBApi("key", "zh-CN", base_url=stand_in.url+"/3", index=index)
+    total = stand_in.stats()["total"]
+    assert api.find("tv7")[0]["id"] == 7
+    assert stand_in.stats()["total"] == total
+    assert api.find("完全不同的名字")[0]["name"] == "完全不同的名字"
+    assert stand_in.stats()["total"] == total+1
+    # 模糊匹配的结果不作为find的答案
+    assert api.find("tv1234x")[0]["name"] == "tv1234x"
+    assert stand_in.stats()["total"] == total+2
+
+
+def test_full_details_refresh(stand_in):
+    api = TMDBApi("key", "zh-CN", base_url=stand_in.url+"/3")
+    api.get_full_details(8, "tv", ("credits",))
+    total = stand_in.stats()["total"]
+    api.get_full_details(8, "tv", ("credits",))
+    assert stand_in.stats()["total"] == total
+    assert api.get_full_details(8, "tv", ("credits",), refresh=True)["credits"]["id"] == 8
+    assert stand_in.stats()["total"] == total+1
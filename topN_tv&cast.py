@@ -3,7 +3,8 @@ import requests.exceptions
 import logging
 import argparse
 from TMDBApi import TMDBApi, load_key_from_file
-from py2neo import Graph, Node, Relationship
+from graph_loader import GraphLoader, GraphBatch, Neo4jLoader, CsvExporter
+from memory_graph import MemoryGraph
 from concurrent import futures
 
 parser = argparse.ArgumentParser()
@@ -21,113 +22,129 @@ parser.add_argument("-v", "--verbose", help="显示日志信息", action="store_
 parser.add_argument("--thread", help="连接的线程数", type=int, default=8)
 parser.add_argument("--retry", help="连接失败重传数", type=int, default=3)
 parser.add_argument("--clearDB", help="是否在初始化时清空数据库原有内容", action="store_true")
+parser.add_argument("--cache", help="TMDB响应缓存文件", default="tmdb_cache.db")
+parser.add_argument("--api-url", help="TMDB API地址，可以指向local_server.py启动的替身服务器")
+parser.add_argument("--graph-file", help="不连接数据库，导入到内嵌的内存图并保存到指定文件，可用memory_graph.py查询")
+parser.add_argument("--export-csv", help="不连接数据库，把图导出为neo4j-admin import使用的CSV到指定目录")
+parser.add_argument("--incremental", help="只获取和更新新上榜或欢迎度、评分变化的影片", action="store_true")
+parser.add_argument("--popularity-delta", help="增量模式下欢迎度的相对变化超过该值时更新",
+                    type=float, default=0.1)
+parser.add_argument("--vote-delta", help="增量模式下评分的变化超过该值时更新", type=float, default=0.1)
+parser.add_argument("-b", "--batch", help="每批写入数据库的影片数", type=int, default=20)
 
 
-def insert_if_not_exists(graph: Graph, id, label, **kwargs)->Node:
-    logging.debug(f"检查节点{label}-{id}是否已经存在...")
-    nodes = graph.nodes.match(label, id=id)
-    if len(nodes) > 0:
-        logging.debug(f"节点{label}-{id}已经存在")
-        return nodes.first()
-    else:
-        logging.debug(f"节点{label}-{id}不存在，插入节点,kwargs: {kwargs}")
-        node = Node(label, id=id, **kwargs)
-        graph.create(node)
-        return node
-
-
-def download_credit_if_not_exists(graph: Graph, api: TMDBApi, id, label)->Node:
-    logging.debug(f"检查演职员{label}-{id}是否已经存在...")
-    nodes = graph.nodes.match(label, id=id)
-    if not len(nodes):
-        logging.debug(f"演职员{label}-{id}不存在，尝试获取信息")
-        res = api.get_person_detail(id)
-        return insert_if_not_exists(
-            graph, id, label,
-            popularity=res["popularity"],
-            birthday=res["birthday"],
-            deathday=res["deathday"],
-            gender=res["gender"],
-            place_of_birth=res["place_of_birth"],
-            name=res["name"]
-        )
-    else:
-        logging.debug(f"演职员{label}-{id}已经存在")
-        return nodes.first()
+PERSON_PROPS = ("popularity", "birthday", "deathday", "gender", "place_of_birth", "name")
 
 
-def import_credit_info(graph, api, id, label, movie_node):
-    # 导入演员关系
-    logging.info(f"导入演员关系...")
-    credits = api.get_credits(id, label)  # 获取电影的演职员表
+def collect_credit_info(batch: GraphBatch, credits, label, id):
+    # 收集演员关系，演职员节点在写入前统一获取
+    logging.info(f"收集演员关系...")
     for title, credit_list in credits.items():
         if title == "id":
             continue
         for credit in credit_list:
             character = credit.get("character") or credit.get("job")
             order = credit.get("order", 0)
-            credit_id = credit["id"]
-            # 插入或搜索到节点
-            credit_node = download_credit_if_not_exists(
-                graph, api, credit_id, title)
-            # 新增一条演员到电影的连线
-            credit_to_movie = Relationship(
-                movie_node, title, credit_node, character=character, order=order)
-            graph.create(credit_to_movie)
-
-
-def import_genre_info(graph, genre_ids, movie_node):
-    logging.info(f"导入类型关系...")
+            # 新增一条电影到演员的连线
+            batch.add_rel(label, id, title, title, credit["id"],
+                          character=character, order=order)
+
+
+def collect_genre_info(batch: GraphBatch, genre_ids, label, id):
+    logging.info(f"收集类型关系...")
     for genre_id in genre_ids:
-        genre_nodes = graph.nodes.match("genre", id=genre_id)
-        if not len(genre_nodes):
-            logging.error(f"cannot find genre {genre_id}!")
-        else:
-            genre_node = genre_nodes.first()
-            movie_to_genre = Relationship(movie_node, "is", genre_node)
-            graph.create(movie_to_genre)
+        batch.add_rel(label, id, "is", "genre", genre_id)
 
 
-def import_country_info(graph, country_names, node):
-    logging.info("导入国家关系...")
+def collect_country_info(batch: GraphBatch, country_names, label, id):
+    logging.info("收集国家关系...")
     for country_name in country_names:
-        country_node = insert_if_not_exists(graph, country_name, "country")
-        movie_to_country = Relationship(node, "origin_country", country_node)
-        graph.create(movie_to_country)
+        if country_name is None:
+            continue
+        batch.add_node("country", country_name)
+        batch.add_rel(label, id, "origin_country", "country", country_name)
 
 
-def import_company_info(graph, companies, movie_node):
-    logging.info("导入出品公司信息...")
+def collect_company_info(batch: GraphBatch, companies, label, id):
+    logging.info("收集出品公司信息...")
     for company in companies:
-        id = company["id"]
-        name = company["name"]
-        country = company.get("origin_country", None)
-        company_node = insert_if_not_exists(graph, id, "company", name=name)
-        import_country_info(graph, [country, ], company_node)
-        movie_to_company = Relationship(
-            movie_node, "production_company", company_node)
-        graph.create(movie_to_company)
-
-
-def import_created_by_info(graph, people, movie_node):
-    logging.info("导入出品人信息...")
+        company_id = company["id"]
+        batch.add_node("company", company_id, name=company["name"])
+        collect_country_info(
+            batch, [company.get("origin_country", None), ], "company", company_id)
+        batch.add_rel(label, id, "production_company", "company", company_id)
+
+
+def collect_created_by_info(batch: GraphBatch, people, label, id):
+    logging.info("收集出品人信息...")
     for person in people:
-        id = person["id"]
-        name = person["name"]
-        gender = person["gender"]
-        person_node = insert_if_not_exists(
-            graph, id, "producer", gender=gender, name=name)
-        movie_to_person = Relationship(movie_node, "created_by", person_node)
-        graph.create(movie_to_person)
+        batch.add_node("producer", person["id"],
+                       gender=person["gender"], name=person["name"])
+        batch.add_rel(label, id, "created_by", "producer", person["id"])
+
+
+def is_changed(item, stored, popularity_delta, vote_delta):
+    """比较榜单中的条目和已经保存的影片节点，判断是否需要重新获取"""
+    if stored is None:
+        return True
+    old, new = stored.get("popularity") or 0, item.get("popularity")
+    if new is not None and abs(new-old) > popularity_delta*max(old, 1e-9):
+        return True
+    old, new = stored.get("vote_average") or 0, item.get("vote_average")
+    return new is not None and abs(new-old) > vote_delta
+
+
+def get_person_detail(api: TMDBApi, id):
+    """获取演职员详情，失败时记录日志并返回None，不影响同一批次的其他影片"""
+    try:
+        res = api.get_person_detail(id)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"无法获取演职员{id}的信息: {e}")
+        return None
+    if "id" not in res:
+        logging.error(f"无法获取演职员{id}的信息: {res}")
+        return None
+    return res
+
+
+def collect_people(batch: GraphBatch, loader: GraphLoader, api: TMDBApi, executor):
+    """为批次中新出现的演职员获取详情并加入节点，数据库中已有的不再请求
+
+    获取失败的演职员没有节点，写入时与之相连的关系会被丢弃，这里记录丢弃的关系数。
+    """
+    for label in ("cast", "crew"):
+        ids = {end for (_, type, _), rels in batch.rels.items() if type == label
+               for _, end in rels}
+        ids -= batch.nodes[label].keys()
+        ids = list(ids - loader.existing_ids(label, ids))
+        logging.info(f"获取{len(ids)}个{label}的详情...")
+        failed = set()
+        for id, res in zip(ids, executor.map(lambda id: get_person_detail(api, id), ids)):
+            if res is None:
+                failed.add(id)
+                continue
+            batch.add_node(label, id, **{k: res.get(k) for k in PERSON_PROPS})
+        if failed:
+            dropped = sum(end in failed for (_, type, _), rels in batch.rels.items()
+                          if type == label for _, end in rels)
+            logging.error(f"cannot find {label} {sorted(failed)}, {dropped} credits dropped!")
 
 
 if __name__ == "__main__":
 
     def process_info(info):
+        """获取一部影片的信息并收集到新的GraphBatch中，不访问数据库"""
+        batch = GraphBatch()
         try:
             id = info.get("id")  # 确定电影id
-            info = api.get_details(id, arg.target)
+            # 详情和演职员表合并为一次请求，已保存的影片发生变化时不使用缓存
+            info = api.get_full_details(id, arg.target, ("credits",),
+                                        refresh=id in stored)
             name = info.get("name") or info.get("title")  # 确定电影名
+            if info.get("success") is False or "id" not in info or name is None:
+                # TMDB返回的错误信息不能当作影片写入，增量模式下会覆盖已有的属性
+                logging.error(f"无法获取影片{id}的信息: {info}")
+                return f"fail at {id} because {info}", None
             logging.info(f"当前影片: {name}")
 
             popularity = info.get("popularity", 0)
@@ -138,55 +155,87 @@ if __name__ == "__main__":
             companies = info.get("production_companies", [])
             created_by = info.get("created_by", [])
 
-            # 插入影片节点
-            logging.info(f"尝试插入影片节点...")
-            movie_node = insert_if_not_exists(
-                graph, id=id,
-                label=arg.target,
-                popularity=popularity,
-                vote_average=vote_average,
-                name=name
-            )
+            # 影片节点，增量模式下更新已有节点的属性
+            add_node = batch.set_node if arg.incremental else batch.add_node
+            add_node(arg.target, id, popularity=popularity,
+                     vote_average=vote_average, name=name)
 
-            # 导入演员关系
-            import_credit_info(graph, api, id, arg.target, movie_node)
+            # 演员关系
+            collect_credit_info(batch, info.get("credits", {}), arg.target, id)
 
-            # 导入类型关系
-            import_genre_info(graph, genre_ids, movie_node)
+            # 类型关系
+            collect_genre_info(batch, genre_ids, arg.target, id)
 
-            # 导入出品国信息
-            import_country_info(graph, origin_countries, movie_node)
+            # 出品国信息
+            collect_country_info(batch, origin_countries, arg.target, id)
 
-            # 导入出品公司信息
-            import_company_info(graph, companies, movie_node)
+            # 出品公司信息
+            collect_company_info(batch, companies, arg.target, id)
 
-            # 导入出品人信息
+            # 出品人信息
+            collect_created_by_info(batch, created_by, arg.target, id)
         except requests.exceptions.RequestException as e:
             logging.error(e)
-            return f"fail at {info} because {e}"
+            return f"fail at {info} because {e}", None
         else:
-            return "success"
+            return "success", batch
+
+    def flush(batch, executor):
+        collect_people(batch, loader, api, executor)
+        loader.write(batch)
+        batch.clear()
 
     arg = parser.parse_args()
     if arg.verbose:
         logging.basicConfig(level=logging.DEBUG)
     api_key = arg.key or load_key_from_file("api.key")
-    url = f"{arg.host}:{arg.port}"
-    graph = Graph(url, username=arg.user, password=arg.password)
-    if arg.clearDB:
-        graph.delete_all()
-    api = TMDBApi(api_key, arg.language, retry=arg.retry)
-
-    # 插入题材节点
+    api = TMDBApi(api_key, arg.language, retry=arg.retry, base_url=arg.api_url,
+                  cache=arg.cache)
+    if arg.export_csv:
+        loader = CsvExporter(arg.export_csv)
+    elif arg.graph_file:
+        loader = MemoryGraph.open(arg.graph_file) if arg.incremental else MemoryGraph(arg.graph_file)
+    else:
+        # 只导出CSV时不需要py2neo
+        from py2neo import Graph
+        url = f"{arg.host}:{arg.port}"
+        graph = Graph(url, username=arg.user, password=arg.password)
+        if arg.clearDB:
+            graph.delete_all()
+        loader = Neo4jLoader(graph)
+    loader.ensure_constraints()
+
+    # 题材节点
+    batch = GraphBatch()
     for target in ("movie", "tv"):
         genre_list = api.get_genre_list(target)
         for genre in genre_list:
-            insert_if_not_exists(
-                graph, genre["id"], "genre", name=genre["name"])
+            batch.add_node("genre", genre["id"], name=genre["name"])
+    loader.write(batch)
+    batch.clear()
 
-    # 获取top列表
+    # 获取top列表，每--batch部影片写入一次数据库
     topN = api.get_popular_iter(arg.target, limit=arg.number)
+    stored = {}
+    if arg.incremental:
+        topN = list(topN)
+        stored = loader.get_nodes(arg.target, [item["id"] for item in topN])
+        changed = [item for item in topN if is_changed(
+            item, stored.get(item["id"]), arg.popularity_delta, arg.vote_delta)]
+        logging.info(
+            f"{len(topN)}部影片中{len(topN)-len(stored)}部新上榜，{len(changed)}部需要更新")
+        topN = changed
     with futures.ThreadPoolExecutor(arg.thread) as executor:
-        results = executor.map(process_info, topN)
-    for result in results:
-        print(result)
+        shows = 0
+        for result, show_batch in executor.map(process_info, topN):
+            print(result)
+            if show_batch is None:
+                continue
+            batch.update(show_batch)
+            shows += 1
+            if shows % arg.batch == 0:
+                flush(batch, executor)
+        if len(batch):
+            flush(batch, executor)
+    loader.close()
+    logging.info(f"缓存统计: {api.cache.stats()}")